@@ -1,14 +1,1229 @@
 #!/usr/bin/env python3
 
+import time
+STARTED = time.perf_counter()
 import polyinterface
+POLYINTERFACE_LOADED = time.perf_counter()
 import sys
+import os
 import json
-from libpurecool.dyson import DysonAccount
-from libpurecool.const import DYSON_PURE_COOL, DYSON_PURE_COOL_DESKTOP, DYSON_PURE_COOL_LINK_TOUR, DYSON_PURE_HOT_COOL, DYSON_PURE_COOL_HUMIDIFY, FanPower, AutoMode, Oscillation, OscillationV2, FanSpeed, FrontalDirection, NightMode, FanMode, FanState, ResetFilter, StandbyMonitoring, QualityTarget, TiltState, HeatMode, HeatState, HeatTarget
-from libpurecool.dyson_pure_state_v2 import DysonPureCoolV2State, DysonEnvironmentalSensorV2State, DysonPureHotCoolV2State
-from libpurecool.dyson_pure_state import DysonPureCoolState, DysonEnvironmentalSensorState
+import re
+import math
+import zlib
+import bisect
+import base64
+import heapq
+import random
+import socket
+import logging
+import resource
+import importlib
+import threading
+import selectors
+from array import array
+from operator import attrgetter
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+from logging.handlers import RotatingFileHandler
 
 LOGGER = polyinterface.LOGGER
+STARTUP_TIMES = OrderedDict([('import polyinterface', POLYINTERFACE_LOADED - STARTED)])
+
+CONNECT_TIMEOUT = 60
+CONNECT_WORKERS = 16
+DEVICE_CACHE = 'device_cache.json'
+IP_CACHE = 'ip_cache.json'
+COMMAND_WINDOW = 300
+DISPATCH_WORKERS = 2
+DISPATCH_QUEUE = 1024
+STALE_TIMEOUT = 180
+RECONNECT_BACKOFF = 15
+RECONNECT_MAX = 900
+HISTORY_HOURS = 24
+HISTORY_RESOLUTION = 30
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+ACK_TIMEOUT = 30
+EXPECT_TIMEOUT = 10
+STATS_FILE = 'stats.json'
+QUERY_TIMEOUT = 5
+REDISCOVER_INTERVAL = 3600
+REDISCOVER_MAX = 86400
+MQTT_TICK = 1
+ENV_POLL_MIN = 15
+ENV_POLL_MAX = 120
+# change per minute of each reading that counts as changing quickly
+ENV_POLL_CHANGE = {'GV1': 5, 'GV2': 5, 'VOCLVL': 2, 'GV3': 2}
+# libpurecool asks for sensor data every 30s from a thread per device
+ENV_REQUEST_INTERVAL = 30
+SNAPSHOT_FILE = 'drivers.json'
+SNAPSHOT_INTERVAL = 60
+GROUP_WORKERS = 16
+GROUP_TIMEOUT = 10
+TRACE_FILE = os.path.join('logs', 'trace.jsonl')
+TRACE_MAX_BYTES = 10 * 1024 * 1024
+TRACE_BACKUPS = 3
+# TRACE command choices: off, driver changes only, then one in N messages per device
+TRACE_MODES = (None, 0, 1, 10, 100, 1000)
+CAPTURE_FILE = os.path.join('logs', 'capture.jsonl')
+CAPTURE_MAX_BYTES = 10 * 1024 * 1024
+CAPTURE_BACKUPS = 5
+# fan node driver, controller drivers with its fleet maximum and mean
+FLEET_SENSORS = (('GV1', 'GV6', 'GV7'), ('GV2', 'GV8', 'GV9'), ('VOCLVL', 'GV10', 'GV11'), ('GV3', 'GV12', 'GV13'))
+FLEET_FILTERS = ('GV8', 'GV9')
+
+
+class JsonStore(object):
+    """
+    Small JSON file written atomically, readable only by the NodeServer user
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as ex:
+            LOGGER.error('Failed to read {}: {}'.format(self.path, ex))
+            return None
+
+    def save(self, data):
+        tmp = self.path + '.tmp'
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp, self.path)
+            return True
+        except (OSError, TypeError, ValueError) as ex:
+            LOGGER.error('Failed to write {}: {}'.format(self.path, ex))
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return False
+
+
+class DriverSnapshot(object):
+    """
+    Last known driver values of every node, saved at most once per interval and only when
+    something was published since the last save
+    """
+    def __init__(self, path=SNAPSHOT_FILE, interval=SNAPSHOT_INTERVAL):
+        self.store = JsonStore(path)
+        self.interval = interval
+        self.saved_at = 0
+        self.mark = None
+
+    def load(self):
+        data = self.store.load()
+        if not data or self.interval <= 0:
+            return {}
+        return data.get('nodes', {})
+
+    def save(self, nodes, now, force=False):
+        if self.interval <= 0 or (not force and now - self.saved_at < self.interval):
+            return False
+        mark = sum(node.drivers_sent for node in nodes.values())
+        if mark == self.mark:
+            return False
+        if self.store.save({'time': now, 'nodes': {address: node.driver_values() for address, node in nodes.items()}}):
+            self.saved_at = now
+            self.mark = mark
+            return True
+        return False
+
+
+@contextmanager
+def timed(label):
+    """
+    Adds the time spent in the block to the startup report
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMES[label] = STARTUP_TIMES.get(label, 0) + time.perf_counter() - started
+
+
+class LazyModule(object):
+    """
+    Imports a module on first attribute access, the import time goes to the startup report
+    """
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            with timed('import ' + self.name):
+                self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+const = LazyModule('libpurecool.const')
+PRODUCT_LOCK = threading.RLock()
+
+
+def _encrypt_credentials(credentials):
+    from Crypto.Cipher import AES
+    # Inverse of libpurecool.utils.decrypt_password, lets cached devices be built with the regular constructors
+    key = bytes(range(1, 33))
+    data = json.dumps({'apPasswordHash': credentials}).encode('utf-8')
+    pad = 16 - len(data) % 16
+    data += bytes([pad]) * pad
+    return base64.b64encode(AES.new(key, AES.MODE_CBC, bytes(16)).encrypt(data)).decode('ascii')
+
+
+def device_to_cache(dev):
+    return {'serial': dev.serial, 'product_type': dev.product_type, 'name': dev.name, 'version': dev.version,
+            'credentials': dev.credentials, 'active': dev.active, 'auto_update': dev.auto_update,
+            'new_version_available': dev.new_version_available}
+
+
+def device_from_cache(entry):
+    node_class = PRODUCTS.get(entry['product_type'])
+    if node_class is None:
+        return None
+    return node_class.load().device_class({'Active': entry.get('active'), 'Serial': entry['serial'], 'Name': entry['name'],
+                                    'Version': entry.get('version'), 'LocalCredentials': _encrypt_credentials(entry['credentials']),
+                                    'AutoUpdate': entry.get('auto_update'), 'NewVersionAvailable': entry.get('new_version_available'),
+                                    'ProductType': entry['product_type']})
+
+
+class DeviceConnector(object):
+    """
+    Connects devices in parallel, each with its own deadline, and brings every node
+    online as soon as its own connection succeeds. An attempt that passes its deadline
+    is abandoned: it is woken up, its client is stopped and the device can be retried.
+    """
+    def __init__(self, workers=CONNECT_WORKERS, timeout=CONNECT_TIMEOUT):
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='DysonConnect')
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.attempts = 0
+        self.connected = []
+        self.failed = []
+        self.timed_out = []
+        self.watchdog = None
+
+    def connect(self, node):
+        with self.lock:
+            if node.address in self.pending:
+                LOGGER.debug('Connection to {} is already in progress'.format(node.name))
+                return
+            if self.watchdog is None:
+                self.connected = []
+                self.failed = []
+                self.timed_out = []
+                self.watchdog = threading.Thread(target=self._watch, name='DysonConnectWatchdog', daemon=True)
+                self.watchdog.start()
+            self.attempts += 1
+            attempt = self.attempts
+            self.pending[node.address] = (attempt, node, node.device, None)
+        self.executor.submit(self._run, node, node.device, attempt)
+
+    def _current(self, node, attempt):
+        entry = self.pending.get(node.address)
+        return entry is not None and entry[0] == attempt
+
+    def _run(self, node, device, attempt):
+        started = time.time()
+        with self.lock:
+            if not self._current(node, attempt):
+                return
+            self.pending[node.address] = (attempt, node, device, started)
+        try:
+            connected = node._connect(device)
+        except Exception as ex:
+            LOGGER.error('Failed to connect to {}: {}'.format(node.name, ex))
+            connected = False
+        elapsed = time.time() - started
+        with self.lock:
+            abandoned = not self._current(node, attempt)
+            if not abandoned:
+                del self.pending[node.address]
+                (self.connected if connected else self.failed).append(node.name)
+        if abandoned:
+            if connected:
+                # finished after the deadline, the watchdog stopped the client and the device is retried
+                node._stop_client(device)
+            return
+        if not connected:
+            LOGGER.error('Unable to connect to {} after {:.1f}s'.format(node.name, elapsed))
+            return
+        LOGGER.info('{} connected in {:.1f}s'.format(node.name, elapsed))
+        try:
+            node.on_connected()
+        except Exception as ex:
+            LOGGER.error('Failed to bring {} online: {}'.format(node.name, ex))
+
+    def _watch(self):
+        while True:
+            time.sleep(1)
+            now = time.time()
+            with self.lock:
+                expired = [entry for entry in self.pending.values() if entry[3] is not None and now - entry[3] > self.timeout]
+                for attempt, node, device, started in expired:
+                    del self.pending[node.address]
+                    self.timed_out.append(node.name)
+            for attempt, node, device, started in expired:
+                LOGGER.error('Connection to {} timed out after {}s, abandoning it'.format(node.name, self.timeout))
+                node._abandon_connect(device)
+            with self.lock:
+                if not self.pending:
+                    LOGGER.info('Connection stage finished: {} connected, {} failed, {} timed out {}'.format(len(self.connected), len(self.failed), len(self.timed_out), self.timed_out))
+                    self.watchdog = None
+                    return
+
+    def is_pending(self, address):
+        with self.lock:
+            return address in self.pending
+
+    def shutdown(self):
+        with self.lock:
+            self.pending.clear()
+        self.executor.shutdown(wait=False)
+
+
+class ConnectionSupervisor(object):
+    """
+    Driven from shortPoll: marks devices stale when they stop sending messages and
+    reconnects them, and the devices that failed to connect, with jittered exponential
+    backoff. All retries go through one heap, there are no per-device timers.
+    """
+    def __init__(self, connector, stale_timeout=STALE_TIMEOUT, backoff=RECONNECT_BACKOFF, backoff_max=RECONNECT_MAX):
+        self.connector = connector
+        self.stale_timeout = stale_timeout
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.retries = {}
+        self.schedule = []
+
+    def _delay(self, attempts):
+        delay = min(self.backoff_max, self.backoff * 2 ** attempts)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _retry(self, node, now):
+        attempts = self.retries[node.address][0] if node.address in self.retries else 0
+        due = now + self._delay(attempts)
+        self.retries[node.address] = (attempts, due)
+        heapq.heappush(self.schedule, (due, node.address))
+
+    def forget(self, address):
+        self.retries.pop(address, None)
+
+    def tick(self, nodes):
+        now = time.time()
+        for node in nodes.values():
+            if not node.started or self.connector.is_pending(node.address):
+                continue
+            if node.connected and now - node.last_message <= self.stale_timeout:
+                self.retries.pop(node.address, None)
+                continue
+            if node.address in self.retries:
+                continue
+            if node.connected:
+                node.mark_stale(now - node.last_message)
+            self._retry(node, now)
+        while self.schedule and self.schedule[0][0] <= now:
+            due, address = heapq.heappop(self.schedule)
+            if address not in self.retries or self.retries[address][1] != due or address not in nodes:
+                continue
+            node = nodes[address]
+            if self.connector.is_pending(address):
+                heapq.heappush(self.schedule, (now + self.backoff, address))
+                self.retries[address] = (self.retries[address][0], now + self.backoff)
+                continue
+            attempts = self.retries[address][0] + 1
+            LOGGER.info('Reconnecting {}, attempt {}'.format(node.name, attempts))
+            self.retries[address] = (attempts, due)
+            self._retry(node, now)
+            node.reconnect()
+
+
+class EnvironmentPoller(object):
+    """
+    Driven from shortPoll: requests sensor data from every device on its own interval. A device
+    whose PM, VOC or NO2 readings change quickly is asked again after the shortest interval, flat
+    readings stretch the interval towards the longest one. Devices start at random phases and every
+    interval is jittered, so the requests are spread over the fleet.
+    """
+    def __init__(self, min_interval=ENV_POLL_MIN, max_interval=ENV_POLL_MAX):
+        self.min_interval = max(1, min_interval)
+        self.max_interval = max(self.min_interval, max_interval)
+        self.lock = threading.Lock()
+        self.intervals = {}
+        self.samples = {}
+        self.due = {}
+        self.schedule = []
+
+    def add(self, node, now):
+        """
+        Takes over sensor data requests for a connected device from the libpurecool thread
+        """
+        request_thread = getattr(node.device, '_request_thread', None)
+        if request_thread is not None:
+            request_thread.stop()
+        with self.lock:
+            # libpurecool waits for the first sensor data on connect, so the first request can wait a full interval
+            interval = self.intervals.setdefault(node.address, self.max_interval)
+            self.samples[node.address] = (now, self._readings(node))
+            self._push(node.address, now + random.uniform(0, interval))
+
+    def forget(self, address):
+        with self.lock:
+            self.intervals.pop(address, None)
+            self.samples.pop(address, None)
+            self.due.pop(address, None)
+
+    def _push(self, address, due):
+        self.due[address] = due
+        heapq.heappush(self.schedule, (due, address))
+
+    def _readings(self, node):
+        values = node.driver_values()
+        return {driver: values[driver] for driver in ENV_POLL_CHANGE if driver in values}
+
+    def _adapt(self, node, now):
+        readings = self._readings(node)
+        then, previous = self.samples.get(node.address, (now, readings))
+        self.samples[node.address] = (now, readings)
+        minutes = max(now - then, 1) / 60
+        change = max([abs(float(readings[driver]) - float(previous[driver])) / ENV_POLL_CHANGE[driver] / minutes
+                      for driver in readings if driver in previous], default=0)
+        interval = self.intervals.get(node.address, self.min_interval)
+        if change >= 1:
+            interval = self.min_interval
+        elif change < 0.5:
+            interval = min(self.max_interval, interval * 1.5)
+        if LOGGER.isEnabledFor(logging.DEBUG) and interval != self.intervals.get(node.address):
+            LOGGER.debug('Sensor data interval for {} is now {:.0f}s'.format(node.name, interval))
+        self.intervals[node.address] = interval
+        return interval
+
+    def tick(self, nodes):
+        now = time.time()
+        due_nodes = []
+        with self.lock:
+            while self.schedule and self.schedule[0][0] <= now:
+                due, address = heapq.heappop(self.schedule)
+                if self.due.get(address) != due:
+                    continue
+                node = nodes.get(address)
+                if node is None or not node.connected:
+                    # picked up again by add() once the device connects
+                    del self.due[address]
+                    continue
+                self._push(address, now + self._adapt(node, now) * random.uniform(0.9, 1.1))
+                due_nodes.append(node)
+        for node in due_nodes:
+            try:
+                node.device.request_environmental_state()
+            except Exception as ex:
+                LOGGER.error('Failed to request sensor data from {}: {}'.format(node.name, ex))
+
+    def interval(self, address):
+        return self.intervals.get(address)
+
+
+class SharedMqttLoop(object):
+    """
+    Runs the MQTT sessions of all connected devices on one thread and one selector. The paho
+    network thread and the libpurecool sensor thread of a device are stopped once it is
+    connected. Keepalives of every client are checked on one shared tick, sensor data requests
+    come from one schedule unless the EnvironmentPoller sends them, and writes from other
+    threads are handed to the loop.
+    """
+    def __init__(self, tick=MQTT_TICK, env_interval=ENV_REQUEST_INTERVAL):
+        self.tick = tick
+        self.env_interval = env_interval
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.requests = []
+        self.seq = 0
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, None)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='DysonMqttLoop', daemon=True)
+        self.thread.start()
+
+    def add(self, node):
+        """
+        Moves a connected device onto the loop, returns False if it keeps its own network thread
+        """
+        client = getattr(node.device, '_mqtt', None)
+        if client is None or client.socket() is None:
+            return False
+        # waits up to paho's one second select() timeout for the network thread to finish
+        client.loop_stop()
+        sock = client.socket()
+        if sock is None:
+            # the connection dropped while the thread was stopping, leave the device as libpurecool runs it
+            client.loop_start()
+            return False
+        request_thread = getattr(node.device, '_request_thread', None)
+        if request_thread is not None:
+            request_thread.stop()
+        client.on_socket_register_write = self._register_write
+        client.on_socket_unregister_write = self._unregister_write
+        client.on_socket_close = self._socket_closed
+        # paho calls register_write only when its write flag is clear, and the network thread can leave
+        # it set with nothing queued. A write sends what is queued and brings the flag in line.
+        client.loop_write()
+        with self.lock:
+            self.clients[client] = node
+            self.selector.register(sock, selectors.EVENT_READ, client)
+            if self.env_interval > 0:
+                self.seq += 1
+                heapq.heappush(self.requests, (time.time() + random.uniform(0, self.env_interval), self.seq, client))
+        if client.want_write():
+            self._register_write(client, None, sock)
+        else:
+            self._wake()
+        return True
+
+    def remove(self, client):
+        """
+        Takes a client off the loop, later writes go straight to its socket from the caller
+        """
+        with self.lock:
+            if self.clients.pop(client, None) is None:
+                return
+            try:
+                self.selector.unregister(client.socket())
+            except (KeyError, ValueError):
+                pass
+        client.on_socket_register_write = None
+        client.on_socket_unregister_write = None
+        client.on_socket_close = None
+
+    def _modify(self, client, sock, events):
+        with self.lock:
+            if client in self.clients:
+                try:
+                    self.selector.modify(sock, events, client)
+                except (KeyError, ValueError):
+                    pass
+
+    def _register_write(self, client, userdata, sock):
+        self._modify(client, sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        self._wake()
+
+    def _unregister_write(self, client, userdata, sock):
+        self._modify(client, sock, selectors.EVENT_READ)
+        # paho clears its flag before this callback, a packet queued by another thread in between
+        # has already been registered and would be left without a write event
+        if client.want_write():
+            self._modify(client, sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+    def _socket_closed(self, client, userdata, sock):
+        # paho calls this before it closes the socket, so it can still be unregistered
+        with self.lock:
+            node = self.clients.pop(client, None)
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+        if node is not None and node.connected:
+            LOGGER.warning('Lost the connection to {}'.format(node.name))
+            node.connected = False
+
+    def _wake(self):
+        if threading.current_thread() is not self.thread:
+            try:
+                self.wake_w.send(b'\0')
+            except OSError:
+                pass
+
+    def _run(self):
+        next_tick = time.time() + self.tick
+        while self.running:
+            try:
+                next_tick = self._step(next_tick)
+            except Exception as ex:
+                # one bad step must not stop the I/O of every device
+                LOGGER.error('Shared MQTT loop error: {}'.format(ex))
+                time.sleep(self.tick)
+
+    def _step(self, next_tick):
+        with self.lock:
+            due = min(next_tick, self.requests[0][0]) if self.requests else next_tick
+        for key, events in self.selector.select(max(0, due - time.time())):
+            client = key.data
+            if client is None:
+                try:
+                    self.wake_r.recv(4096)
+                except OSError:
+                    pass
+                continue
+            try:
+                if events & selectors.EVENT_READ:
+                    client.loop_read()
+                if events & selectors.EVENT_WRITE:
+                    client.loop_write()
+            except Exception as ex:
+                LOGGER.error('MQTT error for {}: {}'.format(self.clients.get(client, client), ex))
+        now = time.time()
+        if now >= next_tick:
+            for client in list(self.clients):
+                try:
+                    client.loop_misc()
+                    # a publish racing a write can leave paho's flag set with the write event off, paho would not ask again
+                    if client.want_write():
+                        self._modify(client, client.socket(), selectors.EVENT_READ | selectors.EVENT_WRITE)
+                except Exception as ex:
+                    LOGGER.error('MQTT keepalive error for {}: {}'.format(self.clients.get(client, client), ex))
+            next_tick = now + self.tick
+        self._request_sensor_data(now)
+        return next_tick
+
+    def _request_sensor_data(self, now):
+        while True:
+            with self.lock:
+                if not self.requests or self.requests[0][0] > now:
+                    return
+                due, seq, client = heapq.heappop(self.requests)
+                node = self.clients.get(client)
+                if node is None:
+                    continue
+                self.seq += 1
+                heapq.heappush(self.requests, (due + self.env_interval, self.seq, client))
+            try:
+                node.device.request_environmental_state()
+            except Exception as ex:
+                LOGGER.error('Failed to request sensor data from {}: {}'.format(node.name, ex))
+
+    def shutdown(self):
+        self.running = False
+        self._wake()
+
+
+class DispatchShard(object):
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queue = OrderedDict()
+        self.processed = 0
+        self.collapsed = 0
+        self.dropped = 0
+
+
+class MessageDispatcher(object):
+    """
+    Takes device messages off the network threads and applies them on a worker pool.
+    Devices are sharded over the workers so each device is processed in order, and a
+    queued message is replaced by a newer one of the same type for the same device.
+    """
+    def __init__(self, workers=DISPATCH_WORKERS, capacity=DISPATCH_QUEUE):
+        workers = max(1, workers)
+        self.capacity = max(1, capacity // workers)
+        self.shards = [DispatchShard() for i in range(workers)]
+        self.running = True
+        for i, shard in enumerate(self.shards):
+            threading.Thread(target=self._work, args=(shard,), name='DysonDispatch_{}'.format(i), daemon=True).start()
+
+    def submit(self, node, msg):
+        shard = self.shards[hash(node.address) % len(self.shards)]
+        key = (node.address, type(msg))
+        with shard.cond:
+            if key in shard.queue:
+                shard.collapsed += 1
+            elif len(shard.queue) >= self.capacity:
+                (address, msg_type), (dropped, dropped_msg) = shard.queue.popitem(last=False)
+                shard.dropped += 1
+                LOGGER.debug('Dispatch queue is full, dropped {} message for {}'.format(msg_type.__name__, dropped.name))
+            shard.queue[key] = (node, msg)
+            shard.cond.notify()
+
+    def _work(self, shard):
+        while True:
+            with shard.cond:
+                while self.running and not shard.queue:
+                    shard.cond.wait()
+                if not self.running:
+                    return
+                key, (node, msg) = shard.queue.popitem(last=False)
+            try:
+                node.process_message(msg)
+            except Exception as ex:
+                LOGGER.error('Failed to process message for {}: {}'.format(node.name, ex), exc_info=True)
+            shard.processed += 1
+
+    def stats(self):
+        return {'depth': sum(len(shard.queue) for shard in self.shards),
+                'processed': sum(shard.processed for shard in self.shards),
+                'collapsed': sum(shard.collapsed for shard in self.shards),
+                'dropped': sum(shard.dropped for shard in self.shards)}
+
+    def shutdown(self):
+        self.running = False
+        for shard in self.shards:
+            with shard.cond:
+                shard.cond.notify_all()
+
+
+class SensorFilter(object):
+    """
+    Deadband and minimum publish interval per environmental driver. The deadband is
+    measured against the last published value, so slow drifts are still reported.
+    """
+    def __init__(self, deadband=None, min_interval=None):
+        self.deadband = deadband or {}
+        self.min_interval = min_interval or {}
+
+    def allows(self, driver, value, published, published_at, now):
+        band = self.deadband.get(driver)
+        if band is not None and abs(value - published) < band:
+            return False
+        interval = self.min_interval.get(driver)
+        if interval is not None and now - published_at < interval:
+            return False
+        return True
+
+
+class SensorHistory(object):
+    """
+    Fixed size ring buffer of timestamped readings over a time window, keeps a running
+    sum and a monotonic max queue per series so mean and max are O(1)
+    """
+    def __init__(self, series, window, resolution=HISTORY_RESOLUTION):
+        self.window = window
+        self.resolution = resolution
+        self.capacity = int(window // resolution) + 1
+        self.times = array('d', bytes(8 * self.capacity))
+        self.values = {name: array('d', bytes(8 * self.capacity)) for name in series}
+        self.totals = dict.fromkeys(series, 0.0)
+        self.peaks = {name: deque() for name in series}
+        self.head = 0
+        self.count = 0
+        self.seq = 0
+
+    def add(self, now, readings):
+        """
+        Stores one reading per series, returns False if it came in faster than the resolution
+        """
+        if self.count and now - self.times[(self.head + self.count - 1) % self.capacity] < self.resolution:
+            return False
+        cutoff = now - self.window
+        while self.count and (self.count == self.capacity or self.times[self.head] <= cutoff):
+            self._pop()
+        idx = (self.head + self.count) % self.capacity
+        self.times[idx] = now
+        for name, value in readings.items():
+            self.values[name][idx] = value
+            self.totals[name] += value
+            peak = self.peaks[name]
+            while peak and peak[-1][1] <= value:
+                peak.pop()
+            peak.append((self.seq, value))
+        self.count += 1
+        self.seq += 1
+        return True
+
+    def _pop(self):
+        oldest = self.seq - self.count
+        for name, values in self.values.items():
+            self.totals[name] -= values[self.head]
+            peak = self.peaks[name]
+            if peak and peak[0][0] == oldest:
+                peak.popleft()
+        self.head = (self.head + 1) % self.capacity
+        self.count -= 1
+
+    def mean(self, name):
+        return self.totals[name] / self.count if self.count else 0
+
+    def max(self, name):
+        peak = self.peaks[name]
+        return peak[0][1] if peak else 0
+
+
+class FleetAggregate(object):
+    """
+    Maximum (or minimum) and mean of one value across devices. Each change is O(log n): a running
+    sum plus a heap whose outdated entries are dropped when they reach the top.
+    """
+    def __init__(self, lowest=False):
+        self.sign = 1 if lowest else -1
+        self.values = {}
+        self.total = 0
+        self.heap = []
+
+    def update(self, key, value):
+        previous = self.values.get(key)
+        if previous == value:
+            return
+        if previous is not None:
+            self.total -= previous
+        self.values[key] = value
+        self.total += value
+        heapq.heappush(self.heap, (self.sign * value, key))
+        if len(self.heap) > 2 * len(self.values) + 16:
+            self.heap = [(self.sign * v, k) for k, v in self.values.items()]
+            heapq.heapify(self.heap)
+
+    def remove(self, key):
+        previous = self.values.pop(key, None)
+        if previous is not None:
+            self.total -= previous
+
+    def extreme(self):
+        """
+        Returns (value, key) of the highest value, the lowest one with lowest=True, (None, None) if empty
+        """
+        heap = self.heap
+        while heap and self.values.get(heap[0][1]) != self.sign * heap[0][0]:
+            heapq.heappop(heap)
+        if not heap:
+            return None, None
+        return self.sign * heap[0][0], heap[0][1]
+
+    def mean(self):
+        return self.total / len(self.values) if self.values else None
+
+
+class FleetAggregates(object):
+    """
+    Air quality and filter life across all fan nodes, updated after every message of a node
+    and published on the controller from shortPoll
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sensors = {driver: FleetAggregate() for driver, _, _ in FLEET_SENSORS}
+        self.filters = FleetAggregate(lowest=True)
+        self.worst = None
+
+    def update(self, node, env):
+        """
+        Sensor values come with environmental messages, filter life with state messages
+        """
+        index = node._driver_index
+        with self.lock:
+            if env:
+                for driver, aggregate in self.sensors.items():
+                    aggregate.update(node.address, index[driver]['value'])
+            else:
+                for driver in FLEET_FILTERS:
+                    self.filters.update((node.address, driver), index[driver]['value'])
+
+    def push(self, node):
+        """
+        Takes all current values of a node, for values that did not come with a message
+        """
+        self.update(node, True)
+        self.update(node, False)
+
+    def forget(self, address):
+        with self.lock:
+            for aggregate in self.sensors.values():
+                aggregate.remove(address)
+            for driver in FLEET_FILTERS:
+                self.filters.remove((address, driver))
+
+    def publish(self, controller, nodes):
+        with self.lock:
+            values = {driver: (aggregate.extreme(), aggregate.mean()) for driver, aggregate in self.sensors.items()}
+            lowest = self.filters.extreme()[0]
+        for driver, max_driver, mean_driver in FLEET_SENSORS:
+            (peak, _), mean = values[driver]
+            controller.setDriver(max_driver, peak if peak is not None else 0)
+            controller.setDriver(mean_driver, round(mean, 1) if mean is not None else 0)
+        controller.setDriver('GV14', lowest if lowest is not None else 0)
+        # the device with the highest PM2.5 is flagged on its own node
+        worst = values['GV1'][0][1]
+        if worst != self.worst:
+            if worst is not None and worst in nodes:
+                LOGGER.info('Worst air is now at {}, PM2.5 {}'.format(nodes[worst].name, values['GV1'][0][0]))
+            # flags restored from the snapshot are cleared too, read from the live driver values
+            for address, node in nodes.items():
+                if node.aggregated and address != worst and node._driver_index['GV17']['value']:
+                    node.setDriver('GV17', 0)
+            if worst in nodes:
+                nodes[worst].setDriver('GV17', 1)
+            self.worst = worst
+
+
+class LatencyHistogram(object):
+    """
+    Latency counts in fixed millisecond buckets, the last bucket has no upper bound
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    @classmethod
+    def merged(cls, histograms):
+        result = cls()
+        for hist in histograms:
+            result.counts = [a + b for a, b in zip(result.counts, hist.counts)]
+            result.count += hist.count
+            result.total += hist.total
+            result.max = max(result.max, hist.max)
+        return result
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, pct):
+        """
+        Upper bound of the bucket holding the percentile, capped by the largest value seen
+        """
+        rank = math.ceil(self.count * pct / 100)
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        labels = ['<={}'.format(bound) for bound in self.buckets] + ['>{}'.format(self.buckets[-1])]
+        return {'count': self.count, 'mean': round(self.mean(), 2), 'p50': round(self.percentile(50), 2), 'p95': round(self.percentile(95), 2),
+                'p99': round(self.percentile(99), 2), 'max': round(self.max, 2), 'buckets': dict(zip(labels, self.counts))}
+
+
+class DeviceMetrics(object):
+    """
+    Message rate, processing time and command acknowledgement latency for one device.
+    A command counts as acknowledged by the first state message that follows it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.rate = 0.0
+        self.rate_mark = (time.time(), 0)
+        self.processing = LatencyHistogram()
+        self.ack = LatencyHistogram()
+        self.awaiting = None
+        self.unacked = 0
+        self.confirmed = 0
+        self.rolled_back = 0
+        self.command_failed = 0
+
+    def command_sent(self):
+        with self.lock:
+            if self.awaiting is None:
+                self.awaiting = time.time()
+
+    def state_received(self, now):
+        with self.lock:
+            if self.awaiting is not None:
+                self.ack.record(now - self.awaiting)
+                self.awaiting = None
+
+    def update(self, now):
+        since, messages = self.rate_mark
+        if now > since:
+            self.rate = (self.messages - messages) / (now - since)
+        self.rate_mark = (now, self.messages)
+        with self.lock:
+            if self.awaiting is not None and now - self.awaiting > ACK_TIMEOUT:
+                self.unacked += 1
+                self.awaiting = None
+
+
+class MessageTrace(object):
+    """
+    Structured debug output, one JSON line per traced device message. sample 0 traces only
+    messages that changed a driver, N traces one in N messages per device, None is off.
+    """
+    def __init__(self, path=TRACE_FILE):
+        self.path = path
+        self.sample = None
+        self.logger = None
+        self.written = 0
+
+    def configure(self, sample):
+        if sample is not None and self.logger is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            handler = RotatingFileHandler(self.path, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUPS)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger = logging.getLogger('dyson-poly.trace')
+            logger.propagate = False
+            logger.setLevel(logging.DEBUG)
+            logger.addHandler(handler)
+            self.logger = logger
+        self.sample = sample
+
+    def record(self, node, msg, report):
+        sample = self.sample
+        if sample is None:
+            return
+        if sample == 0:
+            if not report:
+                return
+        else:
+            node.trace_count += 1
+            if node.trace_count % sample:
+                return
+        entry = {'time': round(time.time(), 3), 'device': node.address, 'message': type(msg).__name__,
+                 'changes': {status['driver']: status['value'] for status in report}}
+        if sample:
+            entry['fields'] = {field: getattr(msg, field) for field in node.message_fields.get(type(msg), ())}
+        self.logger.debug(json.dumps(entry, separators=(',', ':')))
+        self.written += 1
+
+
+class MessageCapture(object):
+    """
+    Raw traffic recorder for tools/replay.py, appends every MQTT message received from a device
+    as one JSON line with the receive time, serial number, product type and original payload
+    """
+    def __init__(self, path=CAPTURE_FILE):
+        self.path = path
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        handler = RotatingFileHandler(self.path, maxBytes=CAPTURE_MAX_BYTES, backupCount=CAPTURE_BACKUPS)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger = logging.getLogger('dyson-poly.capture')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(handler)
+        self.written = 0
+
+    def attach(self, node):
+        """
+        Records the messages of the device's current MQTT client ahead of libpurecool's own handler
+        """
+        client = getattr(node.device, '_mqtt', None)
+        if client is None or client.on_message is None or getattr(client.on_message, 'captured', False):
+            return
+        on_message = client.on_message
+        # the payload is JSON already, it is written as is instead of being parsed and dumped again
+        fields = ',"serial":{},"type":{},"payload":'.format(json.dumps(node.device.serial), json.dumps(node.device.product_type))
+
+        def capture(client, userdata, msg):
+            self.record(fields, msg.payload)
+            on_message(client, userdata, msg)
+        capture.captured = True
+        client.on_message = capture
+
+    def record(self, fields, payload):
+        payload = payload.decode('utf-8', 'replace').replace('\n', ' ').replace('\r', ' ')
+        self.logger.debug('{{"time":{:.3f}{}{}}}'.format(time.time(), fields, payload))
+        self.written += 1
+
+
+class CommandQueue(object):
+    """
+    Outbound commands for one device. A command replaces any pending command of the same
+    kind, debounced commands are held for the window so only the latest one is sent.
+    """
+    def __init__(self, name, window=COMMAND_WINDOW, on_sent=None, on_failed=None):
+        self.name = name
+        self.window = window / 1000
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.pending = OrderedDict()
+        self.timer = None
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    def submit(self, kind, func, *args, debounce=False):
+        with self.lock:
+            if self.pending.pop(kind, None) is not None:
+                self.coalesced += 1
+            self.pending[kind] = (func, args, {})
+        self._schedule(debounce)
+
+    def merge(self, kind, func, clear=(), debounce=False, **fields):
+        """
+        Folds keyword arguments into the pending call of the same kind, so several fields
+        end up in one call. Fields listed in clear are dropped from the pending call.
+        """
+        with self.lock:
+            pending = self.pending.pop(kind, None)
+            if pending is None:
+                merged = {}
+            else:
+                self.coalesced += 1
+                merged = pending[2]
+                for field in clear:
+                    merged.pop(field, None)
+            merged.update(fields)
+            self.pending[kind] = (func, (), merged)
+        self._schedule(debounce)
+
+    def _schedule(self, debounce):
+        if not debounce or self.window <= 0:
+            self.flush()
+            return
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.send_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                pending = list(self.pending.items())
+                self.pending.clear()
+            for kind, (func, args, kwargs) in pending:
+                try:
+                    func(*args, **kwargs)
+                    self.sent += 1
+                    if self.on_sent is not None:
+                        self.on_sent()
+                except Exception as ex:
+                    self.failed += 1
+                    LOGGER.error('Command {} failed for {}: {}'.format(kind, self.name, ex))
+                    if self.on_failed is not None:
+                        self.on_failed(kind)
+
+    def cancel(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.pending.clear()
+
+
+def _kelvin_to_c(value):
+    return round(float(value) - 273.15, 2)
+
+
+def _kelvin_to_f(value):
+    return round(float(value) * 9 / 5 - 459.67, 2)
+
+
+def _heat_target_to_f(value):
+    heat_sp = float(value) / 10
+    # heat_sp_c = round(heat_sp - 273.15)
+    return round((heat_sp - 273.15) * 9 / 5 + 32)
+
+
+def _flag(on_value):
+    return lambda value: 1 if value == on_value else 0
+
+
+def _lookup(table, default=0):
+    return lambda value: table.get(value, default)
+
+
+def _fan_state_v2(state):
+    if state.fan_power == const.FanPower.POWER_ON.value:
+        if state.auto_mode == const.AutoMode.AUTO_ON.value:
+            return 11
+        return int(state.speed)
+    return 0
+
+
+def _fan_state_v1(state):
+    if state.fan_state == const.FanState.FAN_ON.value:
+        if state.fan_mode == const.FanMode.AUTO.value:
+            return 11
+        return int(state.speed)
+    return 0
+
+
+def _message(state):
+    return state
+
+
+def _aqi(concentration, breakpoints, precision):
+    c = math.floor(concentration * precision) / precision
+    for c_lo, c_hi, i_lo, i_hi in breakpoints:
+        if c <= c_hi:
+            return round((i_hi - i_lo) / (c_hi - c_lo) * (c - c_lo) + i_lo)
+    return 500
+
+
+def compile_message_map(tables):
+    """
+    Turns {message class: ((field, converter, driver), ...)} into per-message tuples of
+    (getter, converter, driver), field None hands the whole message to the converter
+    """
+    return {msg_type: tuple((_message if field is None else attrgetter(field), converter, driver) for field, converter, driver in table)
+            for msg_type, table in tables.items()}
+
+
+# State tables use libpurecool.const, so they are built when a product class is loaded
+def v2_state_map():
+    return (
+        (None, _fan_state_v2, 'ST'),
+        ('oscillation', _flag(const.OscillationV2.OSCILLATION_ON.value), 'GV4'),
+        ('front_direction', _lookup({const.FrontalDirection.FRONTAL_ON.value: 0}, 1), 'AIRFLOW'),
+        ('night_mode', _flag('ON'), 'GV5'),
+        ('oscillation_angle_low', int, 'GV6'),
+        ('oscillation_angle_high', int, 'GV7'),
+        ('carbon_filter_state', int, 'GV8'),
+        ('hepa_filter_state', int, 'GV9')
+    )
+
+
+def hot_cool_state_map():
+    return v2_state_map() + (
+        ('tilt', _flag(const.TiltState.TILT_TRUE.value), 'GV11'),
+        ('heat_mode', _flag(const.HeatMode.HEAT_ON.value), 'CLIMD'),
+        ('heat_state', _flag(const.HeatState.HEAT_STATE_ON.value), 'CLIHCS'),
+        ('heat_target', _heat_target_to_f, 'CLISPH')
+    )
+
+
+V2_ENV_MAP = (
+        ('temperature', _kelvin_to_c, 'CLITEMP'),
+        ('temperature', _kelvin_to_f, 'GV0'),
+        ('humidity', int, 'CLIHUM'),
+        ('particulate_matter_25', int, 'GV1'),
+        ('particulate_matter_10', int, 'GV2'),
+        ('volatile_organic_compounds', int, 'VOCLVL'),
+        ('nitrogen_dioxide', int, 'GV3'),
+        ('sleep_timer', int, 'GV10')
+)
+
+
+def v1_state_map():
+    return (
+        (None, _fan_state_v1, 'ST'),
+        ('oscillation', _flag(const.Oscillation.OSCILLATION_ON.value), 'GV4'),
+        ('night_mode', _flag('ON'), 'GV5'),
+        ('quality_target', _lookup({const.QualityTarget.QUALITY_NORMAL.value: 1, const.QualityTarget.QUALITY_BETTER.value: 2, const.QualityTarget.QUALITY_HIGH.value: 3}), 'GV6'),
+        ('standby_monitoring', _flag(const.StandbyMonitoring.STANDBY_MONITORING_ON.value), 'GV7'),
+        ('filter_life', int, 'GV8')
+    )
+
+
+V1_ENV_MAP = (
+    ('temperature', _kelvin_to_c, 'CLITEMP'),
+    ('temperature', _kelvin_to_f, 'GV0'),
+    ('humidity', int, 'CLIHUM'),
+    ('dust', int, 'GV1'),
+    ('volatil_organic_compounds', int, 'VOCLVL'),
+    ('sleep_timer', int, 'GV10')
+)
+
+# US EPA 24 hour breakpoints: concentration low, high, index low, high
+PM25_AQI = ((0.0, 9.0, 0, 50), (9.1, 35.4, 51, 100), (35.5, 55.4, 101, 150), (55.5, 125.4, 151, 200), (125.5, 225.4, 201, 300), (225.5, 325.4, 301, 500))
+PM10_AQI = ((0, 54, 0, 50), (55, 154, 51, 100), (155, 254, 101, 150), (255, 354, 151, 200), (355, 424, 201, 300), (425, 604, 301, 500))
+
+SENSOR_DRIVERS = ('CLITEMP', 'GV0', 'CLIHUM', 'GV1', 'GV2', 'VOCLVL', 'GV3')
+
+# ROTATE choices and the oscillation range each one sets
+OSCILLATION_ANGLES = {45: (157, 202), 90: (135, 225), 180: (90, 270), 350: (5, 355)}
 
 
 class Controller(polyinterface.Controller):
@@ -17,229 +1232,1028 @@ class Controller(polyinterface.Controller):
         self.name = 'Dyson Controller'
         self.address = 'dysonctrl'
         self.primary = self.address
-        self.dyson = None
-        self.devlist = None
+        self.accounts = []
+        self.offline = False
+        self.sessions = {}
+        self.addresses = {}
+        self.group_executor = None
+        self.snapshot = None
+        self.restored = {}
+        self.query_timeout = QUERY_TIMEOUT
+        self.query_thread = None
+        self.rediscover_interval = REDISCOVER_INTERVAL
+        self.rediscover_delay = REDISCOVER_INTERVAL
+        self.rediscover_at = 0
+        self.cloud_fingerprint = None
+        self.discover_lock = threading.Lock()
+        self.mqtt_loop = None
+        self.env_poll = None
+        self.capture = None
+        self.devlist = {}
+        self.connector = None
+        self.supervisor = None
+        self.dispatcher = None
+        self.sensor_filter = None
+        self.trace = MessageTrace()
+        self.fleet = FleetAggregates()
+        self.command_window = COMMAND_WINDOW
+        self.history_window = HISTORY_HOURS * 3600
+        self.device_cache = JsonStore(DEVICE_CACHE)
+        self.ip_cache = JsonStore(IP_CACHE)
+        self.known_ips = {}
+        self.ip_lock = threading.Lock()
+
+    def _int_param(self, name, default):
+        if name not in self.polyConfig['customParams']:
+            return default
+        try:
+            return int(self.polyConfig['customParams'][name])
+        except ValueError:
+            LOGGER.error('Invalid {} value: {}, using default {}'.format(name, self.polyConfig['customParams'][name], default))
+            return default
+
+    def _bool_param(self, name):
+        return self.polyConfig['customParams'].get(name, 'false').strip().lower() in ('true', 'yes', 'on', '1')
 
     def start(self):
         # LOGGER.setLevel(logging.INFO)
         LOGGER.info('Started Dyson controller')
-        if 'username' not in self.polyConfig['customParams'] or 'password' not in self.polyConfig['customParams']:
-            LOGGER.error('Please specify username and password in the NodeServer configuration parameters');
-            return False
-        username = self.polyConfig['customParams']['username']
-        password = self.polyConfig['customParams']['password']
-        if 'country' in self.polyConfig['customParams']:
-            country = self.polyConfig['customParams']['country']
+        self.connector = DeviceConnector(self._int_param('connect_workers', CONNECT_WORKERS), self._int_param('connect_timeout', CONNECT_TIMEOUT))
+        self.supervisor = ConnectionSupervisor(self.connector, self._int_param('stale_timeout', STALE_TIMEOUT), self._int_param('reconnect_backoff', RECONNECT_BACKOFF), self._int_param('reconnect_max', RECONNECT_MAX))
+        self.command_window = self._int_param('command_window', COMMAND_WINDOW)
+        self.query_timeout = self._int_param('query_timeout', QUERY_TIMEOUT)
+        self.rediscover_interval = self.rediscover_delay = self._int_param('rediscover_interval', REDISCOVER_INTERVAL)
+        self.rediscover_at = time.time() + self.rediscover_interval
+        self.history_window = max(1, self._int_param('history_hours', HISTORY_HOURS)) * 3600
+        self.snapshot = DriverSnapshot(SNAPSHOT_FILE, self._int_param('snapshot_interval', SNAPSHOT_INTERVAL))
+        self.dispatcher = MessageDispatcher(self._int_param('dispatch_workers', DISPATCH_WORKERS), self._int_param('dispatch_queue', DISPATCH_QUEUE))
+        self.group_executor = ThreadPoolExecutor(max_workers=GROUP_WORKERS, thread_name_prefix='DysonGroup')
+        env_poll_max = self._int_param('env_poll_max', ENV_POLL_MAX)
+        if env_poll_max > 0:
+            self.env_poll = EnvironmentPoller(self._int_param('env_poll_min', ENV_POLL_MIN), env_poll_max)
+            LOGGER.info('Requesting sensor data every {}s to {}s depending on how fast the readings change'.format(self.env_poll.min_interval, self.env_poll.max_interval))
+        if self._bool_param('shared_io'):
+            LOGGER.info('Running all device connections on one shared I/O thread')
+            self.mqtt_loop = SharedMqttLoop(env_interval=0 if self.env_poll is not None else ENV_REQUEST_INTERVAL)
+        self.offline = self._bool_param('offline')
+        if self.offline:
+            # No accounts, so the cache is never refreshed or overwritten from the cloud
+            LOGGER.info('Offline, the devices are started from {} and the Dyson cloud is not used'.format(DEVICE_CACHE))
         else:
-            country = 'US'
-
-        try:
-            self.dyson = DysonAccount(username, password, country)
-        except Exception as ex:
-            LOGGER.error('ERROR connecting to the Dyson API: {}'.format(ex))
-            return
+            self.accounts = self._parse_accounts()
+            if not self.accounts:
+                LOGGER.error('Please specify username and password or accounts in the NodeServer configuration parameters');
+                return False
         if 'devlist' in self.polyConfig['customParams']:
             try:
-                self.devlist = json.loads(self.polyConfig['customParams']['devlist'])
+                self.devlist = self._parse_devlist(json.loads(self.polyConfig['customParams']['devlist']))
             except Exception as ex:
                 LOGGER.error('Failed to parse the devlist: {}'.format(ex))
                 return False
-        logged_in = self.dyson.login()
-        if not logged_in:
-            LOGGER.error('Failed to login to Dyson account')
+        self.known_ips = self.ip_cache.load() or {}
+        self.sensor_filter = self._parse_sensor_filter()
+        self._set_trace(self._parse_trace())
+        if self._bool_param('capture'):
+            self.capture = MessageCapture()
+            LOGGER.info('Recording all device messages to {}'.format(self.capture.path))
+        with timed('device cache'):
+            self.restored = self.snapshot.load()
+            cached = self._load_device_cache()
+        if cached:
+            LOGGER.info('Starting {} device(s) from the cache{}'.format(len(cached), '' if self.offline else ', refreshing from the Dyson cloud in the background'))
+            with timed('add nodes'):
+                self._sync_devices(cached)
+            if not self.offline:
+                threading.Thread(target=self.discover, name='DysonCloudRefresh', daemon=True).start()
+        elif self.offline:
+            LOGGER.error('No devices in {}, offline mode needs a device cache'.format(DEVICE_CACHE))
+            return False
+        else:
+            with timed('cloud discovery'):
+                self.discover()
+        self._add_groups()
+        self.report_startup()
+
+    def report_startup(self):
+        # ru_maxrss is in KiB on Linux and FreeBSD
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        LOGGER.info('Started in {:.0f}ms, peak RSS {:.1f} MiB: {}'.format((time.perf_counter() - STARTED) * 1000, rss,
+                    ', '.join('{} {:.1f}ms'.format(label, seconds * 1000) for label, seconds in list(STARTUP_TIMES.items()))))
+
+    def _parse_accounts(self):
+        params = self.polyConfig['customParams']
+        accounts = []
+        if 'username' in params and 'password' in params:
+            accounts.append((params['username'], params['password'], params.get('country', 'US')))
+        if 'accounts' in params:
+            try:
+                entries = json.loads(params['accounts'])
+            except ValueError as ex:
+                LOGGER.error('Failed to parse the accounts: {}'.format(ex))
+                entries = []
+            for entry in entries:
+                if not isinstance(entry, dict) or 'username' not in entry or 'password' not in entry:
+                    LOGGER.error('Invalid account entry, username and password are required')
+                elif any(entry['username'] == username for username, _, _ in accounts):
+                    LOGGER.error('Account {} is listed more than once'.format(entry['username']))
+                else:
+                    accounts.append((entry['username'], entry['password'], entry.get('country', 'US')))
+        if len(accounts) > 1:
+            LOGGER.info('Using {} Dyson accounts: {}'.format(len(accounts), ', '.join(username for username, _, _ in accounts)))
+        return accounts
+
+    def _parse_devlist(self, devlist):
+        index = {}
+        for dev in devlist:
+            if not isinstance(dev, dict) or 'sn' not in dev or 'ip' not in dev:
+                LOGGER.error('Invalid entry: {}'.format(dev))
+            else:
+                index[dev['sn'].replace('-', '').lower()[:14]] = dev['ip']
+        LOGGER.info('Loaded {} device(s) from the devlist'.format(len(index)))
+        return index
+
+    def _parse_groups(self):
+        if 'groups' not in self.polyConfig['customParams']:
+            return {}
+        try:
+            groups = json.loads(self.polyConfig['customParams']['groups'])
+            if not isinstance(groups, dict):
+                raise ValueError('groups must be a JSON object of group names and member lists')
+        except ValueError as ex:
+            LOGGER.error('Failed to parse the groups: {}'.format(ex))
+            return {}
+        parsed = {}
+        for name, members in groups.items():
+            if not isinstance(members, list) or not all(isinstance(member, str) for member in members):
+                LOGGER.error('Invalid members of group {}, use a list of serial numbers or names'.format(name))
+            else:
+                parsed[name] = members
+        return parsed
+
+    def _add_groups(self):
+        groups = [('grpall', 'All Dyson Fans', None)]
+        for name, members in self._parse_groups().items():
+            address = 'grp' + re.sub('[^a-z0-9]', '', name.lower())[:11]
+            if any(address == existing for existing, _, _ in groups):
+                LOGGER.error('Group {} has the same address {} as another group, skipping it'.format(name, address))
+            else:
+                groups.append((address, name, members))
+        for address, name, members in groups:
+            node = self.nodes.get(address)
+            if isinstance(node, DysonGroup):
+                node.members = members
+            else:
+                LOGGER.info('Adding group {} with {} member(s)'.format(name, 'all' if members is None else len(members)))
+                self.addNode(DysonGroup(self, self.address, address, name, members))
+
+    def _parse_sensor_filter(self):
+        params = self.polyConfig['customParams']
+        if 'deadband' not in params and 'min_interval' not in params:
+            return None
+        deadband = {}
+        min_interval = {}
+        try:
+            for driver, band in json.loads(params.get('deadband', '{}')).items():
+                if driver in SENSOR_DRIVERS:
+                    deadband[driver] = float(band)
+                else:
+                    LOGGER.error('Deadband is only supported for the sensor drivers {}, ignoring {}'.format(SENSOR_DRIVERS, driver))
+            interval = json.loads(params.get('min_interval', '{}'))
+            if not isinstance(interval, dict):
+                interval = {driver: interval for driver in SENSOR_DRIVERS}
+            for driver, seconds in interval.items():
+                if driver in SENSOR_DRIVERS:
+                    min_interval[driver] = float(seconds)
+                else:
+                    LOGGER.error('Minimum interval is only supported for the sensor drivers {}, ignoring {}'.format(SENSOR_DRIVERS, driver))
+        except (ValueError, TypeError, AttributeError) as ex:
+            LOGGER.error('Failed to parse the sensor filter: {}'.format(ex))
+            return None
+        LOGGER.info('Sensor deadband: {}, minimum interval: {}'.format(deadband, min_interval))
+        return SensorFilter(deadband, min_interval)
+
+    def _parse_trace(self):
+        value = self.polyConfig['customParams'].get('trace', 'off').strip().lower()
+        if value == 'off':
+            return None
+        if value == 'changes':
+            return 0
+        try:
+            sample = int(value)
+        except ValueError:
+            sample = -1
+        if sample < 1:
+            LOGGER.error('Invalid trace value: {}, use off, changes or a number N to trace one in N messages'.format(value))
+            return None
+        return sample
+
+    def _set_trace(self, sample):
+        self.trace.configure(sample)
+        if sample is None:
+            LOGGER.info('Message trace is off')
+        elif sample == 0:
+            LOGGER.info('Tracing driver changes to {}'.format(self.trace.path))
         else:
-            self.discover()
+            LOGGER.info('Tracing one in {} messages per device to {}'.format(sample, self.trace.path))
+        self.setDriver('GV5', TRACE_MODES.index(sample) if sample in TRACE_MODES else 0)
+
+    def set_trace(self, command):
+        mode = int(command.get('value'))
+        if 0 <= mode < len(TRACE_MODES):
+            self._set_trace(TRACE_MODES[mode])
+        else:
+            LOGGER.error('Invalid trace mode: {}'.format(mode))
+
+    def learn_ip(self, address, ip):
+        with self.ip_lock:
+            if self.known_ips.get(address) == ip:
+                return
+            self.known_ips[address] = ip
+            self.ip_cache.save(self.known_ips)
+
+    def forget_ip(self, address):
+        with self.ip_lock:
+            if self.known_ips.pop(address, None) is not None:
+                self.ip_cache.save(self.known_ips)
+
+    def _load_device_cache(self):
+        data = self.device_cache.load()
+        if not data:
+            return []
+        devices = []
+        for entry in data.get('devices', []):
+            try:
+                dev = device_from_cache(entry)
+            except Exception as ex:
+                LOGGER.error('Invalid device cache entry {}: {}'.format(entry.get('serial'), ex))
+                continue
+            if dev is not None:
+                if 'address' in entry:
+                    self.addresses[entry['serial']] = entry['address']
+                devices.append(dev)
+        return devices
+
+    def _new_account(self, username, password, country):
+        with timed('import libpurecool.dyson'):
+            from libpurecool.dyson import DysonAccount
+        return DysonAccount(username, password, country)
+
+    def _login(self, account):
+        username = account[0]
+        try:
+            session = self.sessions.get(username)
+            if session is None:
+                session = self.sessions[username] = self._new_account(*account)
+            if session.logged:
+                return session
+            logged_in = session.login()
+        except Exception as ex:
+            LOGGER.error('ERROR connecting to the Dyson API as {}: {}'.format(username, ex))
+            return None
+        if not logged_in:
+            LOGGER.error('Failed to login to Dyson account {}'.format(username))
+            return None
+        return session
+
+    def _account_devices(self, account):
+        """
+        Logs in and returns the device list of one account, None if either step failed
+        """
+        session = self._login(account)
+        if session is None:
+            return None
+        try:
+            return session.devices()
+        except Exception as ex:
+            LOGGER.error('Failed to get the device list of {} from the Dyson cloud: {}'.format(account[0], ex))
+            return None
 
     def stop(self):
         LOGGER.info('Dyson is stopping')
-        for node in self.nodes:
+        if self.snapshot is not None:
+            self.snapshot.save(self.fan_nodes(), time.time(), force=True)
+        for node in list(self.nodes):
             if self.nodes[node].address != self.address:
                 self.nodes[node].stop()
+        if self.connector is not None:
+            self.connector.shutdown()
+        if self.dispatcher is not None:
+            self.dispatcher.shutdown()
+        if self.group_executor is not None:
+            self.group_executor.shutdown(wait=False)
+        if self.mqtt_loop is not None:
+            self.mqtt_loop.shutdown()
+
+    def fan_nodes(self):
+        return {address: node for address, node in list(self.nodes.items()) if isinstance(node, DysonNode)}
+
+    def shortPoll(self):
+        nodes = self.fan_nodes()
+        now = time.time()
+        for node in nodes.values():
+            if node.expected:
+                node.expire_expectations(now)
+        if self.supervisor is not None:
+            self.supervisor.tick(nodes)
+        if self.env_poll is not None:
+            self.env_poll.tick(nodes)
+        self.fleet.publish(self, nodes)
+        if self.snapshot is not None:
+            self.snapshot.save(nodes, now)
+
+    def longPoll(self):
+        if self.dispatcher is not None:
+            stats = self.dispatcher.stats()
+            LOGGER.info('Dispatch queue depth: {depth}, processed: {processed}, collapsed: {collapsed}, dropped: {dropped}'.format(**stats))
+        self.update_metrics()
+        if self.rediscover_interval > 0 and self.accounts and time.time() >= self.rediscover_at and not self.discover_lock.locked():
+            self.rediscover_at = time.time() + self.rediscover_delay
+            threading.Thread(target=self.discover, name='DysonRediscover', daemon=True).start()
+
+    def update_metrics(self):
+        now = time.time()
+        nodes = list(self.fan_nodes().values())
+        for node in nodes:
+            node.metrics.update(now)
+        self.setDriver('GV0', round(sum(node.metrics.rate for node in nodes), 2))
+        self.setDriver('GV1', round(LatencyHistogram.merged(node.metrics.processing for node in nodes).percentile(95), 1))
+        self.setDriver('GV2', round(LatencyHistogram.merged(node.metrics.ack for node in nodes).percentile(95), 1))
+        self.setDriver('GV3', sum(node.reconnects for node in nodes))
+        self.setDriver('GV4', sum(1 for node in nodes if node.connected))
+
+    def stats(self, command=None):
+        devices = {}
+        for address, node in self.fan_nodes().items():
+            metrics = node.metrics
+            devices[address] = {
+                'name': node.name, 'connected': node.connected, 'stale': node.stale, 'reconnects': node.reconnects,
+                'messages': metrics.messages, 'messages_per_second': round(metrics.rate, 3),
+                'processing_ms': metrics.processing.to_dict(), 'command_ack_ms': metrics.ack.to_dict(), 'commands_unacked': metrics.unacked,
+                'commands_sent': node.command_queue.sent, 'commands_coalesced': node.command_queue.coalesced, 'commands_failed': node.command_queue.failed,
+                'drivers_sent': node.drivers_sent, 'drivers_suppressed': node.drivers_suppressed, 'drivers_filtered': node.drivers_filtered,
+                'optimistic_pending': len(node.expected), 'optimistic_confirmed': metrics.confirmed, 'optimistic_rolled_back': metrics.rolled_back,
+                'optimistic_failed': metrics.command_failed,
+                'env_interval_s': self.env_poll.interval(address) if self.env_poll is not None else ENV_REQUEST_INTERVAL
+            }
+        snapshot = {'time': time.time(), 'devices': devices, 'threads': threading.active_count(), 'startup_ms': {label: round(seconds * 1000, 1) for label, seconds in list(STARTUP_TIMES.items())}}
+        if self.dispatcher is not None:
+            snapshot['dispatch'] = self.dispatcher.stats()
+        snapshot['groups'] = {node.name: node.last_result for node in list(self.nodes.values()) if isinstance(node, DysonGroup)}
+        if JsonStore(STATS_FILE).save(snapshot):
+            LOGGER.info('Saved stats for {} device(s) to {}'.format(len(devices), STATS_FILE))
 
     def updateInfo(self):
         pass
 
-    def query(self):
-        for node in self.nodes:
-            self.nodes[node].reportDrivers()
+    def query(self, command=None):
+        """
+        Asks every connected device for fresh data at once, then waits for the replies under one
+        deadline and reports all nodes from a background thread, not from Polyglot's input thread
+        """
+        if self.query_thread is not None and self.query_thread.is_alive():
+            LOGGER.info('A query is already waiting for the devices, its results will be reported')
+            return
+        nodes = self.fan_nodes()
+        pending = [(node, node.request_refresh()) for node in nodes.values() if node.connected]
+        self.query_thread = threading.Thread(target=self._report_query, args=(nodes, pending, time.time()), name='DysonQuery', daemon=True)
+        self.query_thread.start()
+
+    def _report_query(self, nodes, pending, started):
+        deadline = started + self.query_timeout
+        refreshed = sum(1 for node, events in pending if node.wait_refresh(events, deadline))
+        LOGGER.info('Refreshed {} of {} device(s) in {:.0f}ms, {} connected device(s) did not answer in time'.format(
+                    refreshed, len(nodes), (time.time() - started) * 1000, len(pending) - refreshed))
+        for node in list(self.nodes.values()):
+            node.reportDrivers()
 
     def discover(self, command=None):
-        for dev in self.dyson.devices():
-            address = dev.serial.replace('-','').lower()[:14]
+        if self.offline:
+            LOGGER.info('Offline, not checking the Dyson cloud for devices')
+            return
+        if not self.accounts:
+            return
+        with self.discover_lock:
+            self._discover()
+        self.rediscover_at = time.time() + self.rediscover_delay
+
+    def _discover(self):
+        if len(self.accounts) == 1:
+            results = [self._account_devices(self.accounts[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(self.accounts), thread_name_prefix='DysonCloud') as pool:
+                results = list(pool.map(self._account_devices, self.accounts))
+        devices = []
+        entries = []
+        serials = set()
+        failed = set()
+        for (username, _, _), account_devices in zip(self.accounts, results):
+            if account_devices is None:
+                failed.add(username)
+                continue
+            for dev in account_devices:
+                # a machine shared between accounts is only added once
+                if dev.serial not in serials:
+                    serials.add(dev.serial)
+                    devices.append(dev)
+                    entries.append(dict(device_to_cache(dev), account=username, address=self._device_address(dev.serial)))
+        if len(failed) == len(self.accounts):
+            return
+        if not failed:
+            fingerprint = zlib.crc32(json.dumps(entries, sort_keys=True).encode())
+            if fingerprint == self.cloud_fingerprint:
+                self.rediscover_delay = min(REDISCOVER_MAX, self.rediscover_delay * 2)
+                LOGGER.info('Dyson cloud device list has not changed, next check in {}s'.format(self.rediscover_delay))
+                return
+            self.cloud_fingerprint = fingerprint
+            self.rediscover_delay = self.rediscover_interval
+        else:
+            # keep the cached machines of accounts that could not be reached
+            cached = (self.device_cache.load() or {}).get('devices', [])
+            entries.extend(entry for entry in cached if entry.get('account') in failed and entry.get('serial') not in serials)
+        if not entries:
+            LOGGER.warning('The Dyson cloud returned no devices, keeping the current nodes')
+            return
+        if self.device_cache.save({'devices': entries}):
+            LOGGER.info('Saved {} device(s) to the cache'.format(len(entries)))
+        self._sync_devices(devices, complete=not failed)
+
+    def _device_address(self, serial):
+        """
+        Node address of a machine, kept in the device cache so it does not change between restarts
+        """
+        address = self.addresses.get(serial)
+        if address is None:
+            address = serial.replace('-','').lower()[:14]
+            if address in self.addresses.values():
+                # the truncated serial is taken by a machine of another account, derive the address from the full serial
+                address = address[:6] + '{:08x}'.format(zlib.crc32(serial.encode()))
+            self.addresses[serial] = address
+        return address
+
+    def _sync_devices(self, devices, complete=False):
+        """
+        Adds new devices and updates the nodes of changed ones, unchanged nodes keep their
+        connection. With the complete device list, nodes of devices that are gone are removed.
+        """
+        listed = set()
+        for dev in devices:
+            address = self._device_address(dev.serial)
             name = dev.name
-            if not address in self.nodes:
-                if dev.product_type in [DYSON_PURE_COOL, DYSON_PURE_COOL_DESKTOP, DYSON_PURE_COOL_HUMIDIFY]:
-                    LOGGER.info('Adding v2 product: {}, name: {}'.format(dev.product_type, dev.name))
-                    self.addNode(DysonPureFan(self, self.address, address, name, dev))
-                elif dev.product_type == DYSON_PURE_HOT_COOL:
-                    LOGGER.info('Adding v2 product: {}, name: {}'.format(dev.product_type, dev.name))
-                    self.addNode(DysonPureHeatFan(self, self.address, address, name, dev))
-                elif dev.product_type == DYSON_PURE_COOL_LINK_TOUR:
-                    LOGGER.info('Adding v1 product: {}, name: {}'.format(dev.product_type, dev.name))
-                    self.addNode(DysonPureFanV1(self, self.address, address, name, dev))
+            listed.add(address)
+            node = self.nodes.get(address)
+            if isinstance(node, DysonNode) and node.device.product_type != dev.product_type:
+                LOGGER.info('Product type of {} changed from {} to {}, replacing its node'.format(name, node.device.product_type, dev.product_type))
+                self._remove_node(node)
+                node = None
+            if isinstance(node, DysonNode):
+                if node.device.credentials != dev.credentials:
+                    LOGGER.info('Local credentials changed for {}, reconnecting'.format(name))
+                    node.replace_device(dev)
+                if node.name != name:
+                    LOGGER.info('Device {} is now named {} in the Dyson cloud'.format(node.name, name))
+                    node.name = node.command_queue.name = name
+                    self.updateNode(node)
+            else:
+                if dev.product_type in PRODUCTS:
+                    node_class = PRODUCTS[dev.product_type].load()
+                    LOGGER.info('Adding {} product: {}, name: {}'.format(node_class.id, dev.product_type, dev.name))
+                    node = self.addNode(node_class(self, self.address, address, name, dev))
+                    restored = self.restored.pop(address, None)
+                    if restored:
+                        # after addNode, which may load the values Polyglot kept for the node
+                        node.restore_drivers(restored)
+                        node.reportDrivers()
                 else:
                     LOGGER.info('Found product type: {}, name: {} but it\'s not yet supported'.format(dev.product_type, dev.name))
+        if complete:
+            for address, node in self.fan_nodes().items():
+                if address not in listed:
+                    LOGGER.info('{} is no longer in the Dyson cloud, removing it'.format(node.name))
+                    self._remove_node(node)
+                    self.forget_ip(address)
+                    self.addresses.pop(node.device.serial, None)
+
+    def _remove_node(self, node):
+        node.removed = True
+        node.stop()
+        if self.supervisor is not None:
+            self.supervisor.forget(node.address)
+        if self.env_poll is not None:
+            self.env_poll.forget(node.address)
+        self.delNode(node.address)
 
     id = 'DYSONCTRL'
-    commands = {'DISCOVER': discover}
-    drivers = [{'driver': 'ST', 'value': 1, 'uom': 2}]
+    commands = {'DISCOVER': discover, 'STATS': stats, 'TRACE': set_trace}
+    drivers = [{'driver': 'ST', 'value': 1, 'uom': 2},
+               {'driver': 'GV0', 'value': 0, 'uom': 56},
+               {'driver': 'GV1', 'value': 0, 'uom': 42},
+               {'driver': 'GV2', 'value': 0, 'uom': 42},
+               {'driver': 'GV3', 'value': 0, 'uom': 56},
+               {'driver': 'GV4', 'value': 0, 'uom': 56},
+               {'driver': 'GV5', 'value': 0, 'uom': 25},
+               {'driver': 'GV6', 'value': 0, 'uom': 56},
+               {'driver': 'GV7', 'value': 0, 'uom': 56},
+               {'driver': 'GV8', 'value': 0, 'uom': 56},
+               {'driver': 'GV9', 'value': 0, 'uom': 56},
+               {'driver': 'GV10', 'value': 0, 'uom': 56},
+               {'driver': 'GV11', 'value': 0, 'uom': 56},
+               {'driver': 'GV12', 'value': 0, 'uom': 56},
+               {'driver': 'GV13', 'value': 0, 'uom': 56},
+               {'driver': 'GV14', 'value': 0, 'uom': 51}
+              ]
+
 
+class DysonNode(polyinterface.Node):
+    device_class = None
+    state_message = None
+    env_message = None
+    message_map = None
+    message_fields = None
+    # included in the controller's fleet air quality and filter life drivers
+    aggregated = False
+
+    @classmethod
+    def load(cls):
+        """
+        Imports the libpurecool modules of the product and compiles its message map, once per class
+        """
+        with PRODUCT_LOCK:
+            if cls.__dict__.get('message_map') is None:
+                with timed('load {}'.format(cls.__name__)):
+                    tables = cls.load_product()
+                    cls.message_fields = {msg_type: tuple(field for field, converter, driver in table if field is not None) for msg_type, table in tables.items()}
+                    cls.message_map = compile_message_map(tables)
+        return cls
+
+    @classmethod
+    def load_product(cls):
+        """
+        Sets device_class, state_message and env_message, returns {message class: table}.
+        The base node has no product, so no message is mapped and device_class stays unset.
+        """
+        return {}
 
-class DysonPureFan(polyinterface.Node):
     def __init__(self, controller, primary, address, name, device):
+        self.load()
         super().__init__(controller, primary, address, name)
         self.device = device
+        self.started = False
+        self.connected = False
+        self.removed = False
+        self.stale = False
+        self.last_message = 0
+        self.reconnects = 0
+        self.metrics = DeviceMetrics()
+        self.command_queue = CommandQueue(name, controller.command_window, self.metrics.command_sent, self.command_failed)
+        self._driver_index = {d['driver']: d for d in self.drivers}
+        self._driver_lock = threading.RLock()
+        self._published = {}
+        self._published_at = {}
+        self._batch = None
+        self.drivers_sent = 0
+        self.drivers_suppressed = 0
+        self.drivers_filtered = 0
+        self.last_report = []
+        self.trace_count = 0
+        self.refresh_events = {}
+        self.query_waiting = False
+        self.expected = {}
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None):
+        d = self._driver_index.get(driver)
+        if d is None:
+            LOGGER.error('Unknown driver {} for {}'.format(driver, self.name))
+            return
+        with self._driver_lock:
+            if self.expected and driver in self.expected and not force and not self._reconcile(driver, value):
+                return
+            d['value'] = value
+            if uom is not None:
+                d['uom'] = uom
+            if not report:
+                return
+            if self._batch is not None:
+                self._batch[driver] = force or self._batch.get(driver, False)
+            else:
+                self._flush({driver: force})
+
+    @contextmanager
+    def driver_batch(self):
+        """
+        Collects setDriver() calls and publishes only the drivers that changed, in one go
+        """
+        with self._driver_lock:
+            if self._batch is not None:
+                yield
+                return
+            self._batch = {}
+            try:
+                yield
+            finally:
+                batch, self._batch = self._batch, None
+                self._flush(batch)
+
+    def _flush(self, batch):
+        report = []
+        for driver, force in batch.items():
+            d = self._driver_index[driver]
+            published = (str(d['value']), d['uom'])
+            if not force and self._published.get(driver) == published:
+                self.drivers_suppressed += 1
+                continue
+            self._published[driver] = published
+            report.append({'address': self.address, 'driver': driver, 'value': published[0], 'uom': published[1]})
+        self.last_report = report
+        if not report:
+            return
+        now = time.time()
+        for status in report:
+            self._published_at[status['driver']] = now
+        self.drivers_sent += len(report)
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('Updating {} driver(s) for {}: {}'.format(len(report), self.name, ' '.join('{}={}'.format(r['driver'], r['value']) for r in report)))
+        for status in report:
+            self.controller.poly.send({'status': status})
+
+    def expect(self, kind, **values):
+        """
+        Shows the values a command of this kind will set right away, call it before the command
+        is queued. Device values that disagree are held back until the device confirms, the
+        expectation times out or the command fails, the last two roll the value back.
+        """
+        deadline = time.time() + self.command_queue.window + EXPECT_TIMEOUT
+        with self.driver_batch():
+            for driver, value in values.items():
+                if value is None:
+                    continue
+                previous = self.expected.pop(driver, None)
+                fallback = previous[2] if previous is not None else self._driver_index[driver]['value']
+                self.setDriver(driver, value)
+                self.expected[driver] = [value, deadline, fallback, kind]
+
+    def _reconcile(self, driver, value):
+        expected = self.expected[driver]
+        if str(value) == str(expected[0]):
+            del self.expected[driver]
+            self.metrics.confirmed += 1
+            return True
+        expected[2] = value
+        return False
+
+    def expire_expectations(self, now):
+        with self.driver_batch():
+            for driver, (value, deadline, fallback, kind) in list(self.expected.items()):
+                if deadline <= now:
+                    del self.expected[driver]
+                    self.metrics.rolled_back += 1
+                    LOGGER.warning('{} did not confirm {}={} in time, rolling back to {}'.format(self.name, driver, value, fallback))
+                    self.setDriver(driver, fallback)
+
+    def command_failed(self, kind):
+        """
+        Rolls back the values shown for a command the device did not take, without waiting for the timeout
+        """
+        with self.driver_batch():
+            for driver, (value, deadline, fallback, expected_kind) in list(self.expected.items()):
+                if expected_kind == kind:
+                    del self.expected[driver]
+                    self.metrics.command_failed += 1
+                    LOGGER.warning('Command {} failed for {}, rolling back {}={} to {}'.format(kind, self.name, driver, value, fallback))
+                    self.setDriver(driver, fallback)
+
+    def driver_values(self):
+        with self._driver_lock:
+            return {d['driver']: d['value'] for d in self.drivers}
+
+    def restore_drivers(self, values):
+        """
+        Starts from the last known values of the previous run, flagged stale until the device sends live data
+        """
+        with self._driver_lock:
+            for driver, value in values.items():
+                d = self._driver_index.get(driver)
+                if d is not None:
+                    d['value'] = value
+            self.stale = True
+            self._driver_index['GV12']['value'] = 1
+        if self.aggregated:
+            self.controller.fleet.push(self)
+
+    def reportDrivers(self):
+        LOGGER.info('Updating All Drivers to ISY for {}({})'.format(self.name, self.address))
+        with self._driver_lock:
+            self._flush({d['driver']: True for d in self.drivers})
 
     def start(self):
+        # Polyglot starts a node again after every addnode, renames included
+        if self.connected or self.controller.connector.is_pending(self.address):
+            LOGGER.debug('{} is already connected or connecting'.format(self.name))
+            return
         LOGGER.info('Starting {}'.format(self.device.name))
-        self._connect()
-        self.updateInfo()
-        self.device.add_message_listener(self.on_message)
-
-    def _connect(self):
-        if self.controller.devlist:
-            LOGGER.info('Looking for device IP in the devlist...')
-            for dev in self.controller.devlist:
-                if 'sn' not in dev or 'ip' not in dev:
-                    LOGGER.error('Invalid entry: {}'.format(dev))
-                else:
-                    if dev['sn'] == self.address:
-                        LOGGER.info('Found IP {} for SN {}'.format(dev['ip'], dev['sn']))
-                        self.device.connect(dev['ip'])
-                        return
+        self.started = True
+        self.controller.connector.connect(self)
+
+    def _connect(self, device):
+        ip = self.controller.devlist.get(self.address)
+        if ip is not None:
+            LOGGER.info('Found IP {} for SN {}'.format(ip, self.address))
+            return device.connect(ip)
+        ip = self.controller.known_ips.get(self.address)
+        if ip is not None:
+            LOGGER.info('Connecting {} to the last known IP {}'.format(self.name, ip))
+            try:
+                if device.connect(ip):
+                    return True
+            except Exception as ex:
+                LOGGER.warning('Failed to connect {} to {}: {}'.format(self.name, ip, ex))
+            LOGGER.warning('Last known IP {} for {} stopped working, falling back to auto connect'.format(ip, self.name))
+            self.controller.forget_ip(self.address)
         LOGGER.info('Trying auto connect...')
-        self.device.auto_connect()
+        if not device.auto_connect():
+            return False
+        self.controller.learn_ip(self.address, device.network_device.address)
+        return True
+
+    def on_connected(self):
+        self.connected = True
+        if self.removed:
+            # removed while the connection was in progress
+            self._disconnect()
+            return
+        if self.controller.mqtt_loop is not None and not self.controller.mqtt_loop.add(self):
+            LOGGER.warning('{} could not be moved to the shared I/O thread, it keeps its own network thread'.format(self.name))
+        self.last_message = time.time()
+        with self.driver_batch():
+            self.updateInfo()
+            self._clear_stale()
+        if self.aggregated:
+            self.controller.fleet.push(self)
+        if self.controller.env_poll is not None:
+            self.controller.env_poll.add(self, self.last_message)
+        if self.controller.capture is not None:
+            self.controller.capture.attach(self)
+        self.device.add_message_listener(self._on_message)
+
+    def _on_message(self, msg):
+        self.last_message = time.time()
+        self.metrics.messages += 1
+        if not isinstance(msg, self.env_message):
+            self.metrics.state_received(self.last_message)
+        self.controller.dispatcher.submit(self, msg)
+
+    def process_message(self, msg):
+        if self.controller.nodes.get(self.address) is not self:
+            # queued before the node was removed or replaced by rediscovery
+            return
+        started = time.perf_counter()
+        with self.driver_batch():
+            self.last_report = []
+            self.on_message(msg)
+            self._clear_stale()
+        if self.aggregated:
+            self.controller.fleet.update(self, isinstance(msg, self.env_message))
+        self.metrics.processing.record(time.perf_counter() - started)
+        if self.refresh_events:
+            event = self.refresh_events.get(type(msg))
+            if event is not None:
+                event.set()
+        if self.controller.trace.sample is not None:
+            self.controller.trace.record(self, msg, self.last_report)
+
+    def request_refresh(self):
+        """
+        Requests current state and sensor data, returns the events set once each reply is applied.
+        A refresh that is still waiting for its replies is shared instead of requested again.
+        """
+        events = self.refresh_events
+        if events and not all(event.is_set() for event in events.values()):
+            return events
+        events = {self.state_message: threading.Event(), self.env_message: threading.Event()}
+        self.refresh_events = events
+        try:
+            self.device.request_current_state()
+            self.device.request_environmental_state()
+        except Exception as ex:
+            LOGGER.error('Failed to request fresh data from {}: {}'.format(self.name, ex))
+        return events
+
+    def wait_refresh(self, events, deadline):
+        for event in events.values():
+            if not event.wait(max(0, deadline - time.time())):
+                break
+        if self.refresh_events is events:
+            self.refresh_events = {}
+        return all(event.is_set() for event in events.values())
+
+    def query(self, command=None):
+        if not self.connected:
+            self.reportDrivers()
+            return
+        if self.query_waiting:
+            # the query already waiting reports the same refresh
+            return
+        self.query_waiting = True
+        threading.Thread(target=self._report_query, args=(self.request_refresh(), time.time() + self.controller.query_timeout),
+                         name='DysonQuery_{}'.format(self.address), daemon=True).start()
+
+    def _report_query(self, events, deadline):
+        try:
+            if not self.wait_refresh(events, deadline):
+                LOGGER.warning('{} did not answer the query in {}s, reporting the last known values'.format(self.name, self.controller.query_timeout))
+            self.reportDrivers()
+        finally:
+            self.query_waiting = False
+
+    def mark_stale(self, silent):
+        LOGGER.warning('No messages from {} for {:.0f}s, marking it stale'.format(self.name, silent))
+        self.stale = True
+        self.setDriver('GV12', 1)
+        try:
+            self.device.request_current_state()
+        except Exception as ex:
+            LOGGER.error('Failed to request state from {}: {}'.format(self.name, ex))
+
+    def _clear_stale(self):
+        if self.stale:
+            LOGGER.info('{} is sending messages again'.format(self.name))
+            self.stale = False
+        self.setDriver('GV12', 0)
 
     def on_message(self, msg):
-        if isinstance(msg, DysonPureCoolV2State):
-            LOGGER.debug('Received State message for {}'.format(self.device.name))
-            if msg.fan_power == FanPower.POWER_ON.value:
-                if msg.auto_mode == AutoMode.AUTO_ON.value:
-                    self.setDriver('ST', 11)
-                else:
-                    self.setDriver('ST', int(msg.speed))
-            else:
-                self.setDriver('ST', 0)
-            if msg.oscillation == OscillationV2.OSCILLATION_ON.value:
-                self.setDriver('GV4', 1)
-            else:
-                self.setDriver('GV4', 0)
-            if msg.front_direction == FrontalDirection.FRONTAL_ON.value:
-                self.setDriver('AIRFLOW', 0)
+        mapping = self.message_map.get(type(msg))
+        if mapping is None:
+            LOGGER.warning('Unknown message received for {}'.format(self.device.name))
+        else:
+            if self.controller.sensor_filter is not None and isinstance(msg, self.env_message):
+                self._apply_filtered(mapping, msg, self.controller.sensor_filter)
             else:
-                self.setDriver('AIRFLOW', 1)
-            if msg.night_mode == 'ON':
-                self.setDriver('GV5', 1)
+                self._apply(mapping, msg)
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('Received {} message for {}: {}'.format(type(msg).__name__, self.device.name, msg))
+
+    def updateInfo(self):
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('Current state of {}: {} {}'.format(self.device.name, self.device.state, self.device.environmental_state))
+        for msg in (self.device.state, self.device.environmental_state):
+            self._apply(self.message_map[type(msg)], msg)
+
+    def _apply(self, mapping, msg):
+        for get, convert, driver in mapping:
+            self.setDriver(driver, convert(get(msg)))
+
+    def _apply_filtered(self, mapping, msg, sensor_filter):
+        now = time.time()
+        for get, convert, driver in mapping:
+            value = convert(get(msg))
+            published = self._published.get(driver)
+            if published is None or published[0] == str(value) or sensor_filter.allows(driver, value, float(published[0]), self._published_at[driver], now):
+                self.setDriver(driver, value)
             else:
-                 self.setDriver('GV5', 0)
-            self.setDriver('GV6', int(msg.oscillation_angle_low))
-            self.setDriver('GV7', int(msg.oscillation_angle_high))
-            self.setDriver('GV8', int(msg.carbon_filter_state))
-            self.setDriver('GV9', int(msg.hepa_filter_state))
-        elif isinstance(msg, DysonEnvironmentalSensorV2State):
-            LOGGER.debug('Received Environmental State message for {}'.format(self.device.name))
-            temp = float(msg.temperature)
-            tempC = round(temp - 273.15, 2)
-            tempF = round(temp * 9 / 5 - 459.67, 2)
-            self.setDriver('CLITEMP', tempC)
-            self.setDriver('GV0', tempF)
-            self.setDriver('CLIHUM', int(msg.humidity))
-            self.setDriver('GV1', int(msg.particulate_matter_25))
-            self.setDriver('GV2', int(msg.particulate_matter_10))
-            self.setDriver('VOCLVL', int(msg.volatile_organic_compounds))
-            self.setDriver('GV3', int(msg.nitrogen_dioxide))
-            self.setDriver('GV10', int(msg.sleep_timer))
-        else:
-            LOGGER.warning('Unknown message received for {}'.format(self.device.name))
-        LOGGER.debug('Received message {}'.format(str(msg)))
+                # keep the latest reading for query() without publishing it
+                self.setDriver(driver, value, report=False)
+                self.drivers_filtered += 1
+
+    def replace_device(self, device):
+        self.stop()
+        self.device = device
+        self.controller.connector.connect(self)
+
+    def reconnect(self):
+        self.reconnects += 1
+        self._disconnect()
+        # libpurecool waits for the first data of a device object only once, connecting the same
+        # object again blocks forever, so every reconnect starts from a new one
+        device = device_from_cache(device_to_cache(self.device))
+        if device is not None:
+            self.device = device
+        self.controller.connector.connect(self)
+
+    def _disconnect(self):
+        self.device.remove_message_listener(self._on_message)
+        self.controller.fleet.forget(self.address)
+        connected, self.connected = self.connected, False
+        try:
+            if connected:
+                self.device.disconnect()
+            # libpurecool only stops its sensor thread on disconnect, the MQTT client keeps running,
+            # also after a failed or abandoned connection attempt
+            self._stop_client(self.device)
+        except Exception as ex:
+            LOGGER.error('Failed to disconnect {}: {}'.format(self.name, ex))
+
+    def _abandon_connect(self, device):
+        """
+        Wakes up a connection attempt that passed its deadline and stops its client
+        """
+        # libpurecool waits for the first state and sensor data without a timeout
+        for name in ('_state_data_available', '_sensor_data_available'):
+            queue = getattr(device, name, None)
+            if queue is not None:
+                queue.put_nowait(False)
+        try:
+            self._stop_client(device)
+        except Exception as ex:
+            LOGGER.error('Failed to stop the abandoned connection to {}: {}'.format(self.name, ex))
+
+    def _stop_client(self, device):
+        mqtt = getattr(device, '_mqtt', None)
+        if mqtt is not None:
+            if self.controller.mqtt_loop is not None:
+                self.controller.mqtt_loop.remove(mqtt)
+            mqtt.disconnect()
+            mqtt.loop_stop()
 
     def stop(self):
-        LOGGER.info('Stopping {}'.format(self.device.name))
-        self.device.disconnect()
+        LOGGER.info('Stopping {}, driver updates sent: {}, suppressed: {}, filtered: {}, commands sent: {}, coalesced: {}'.format(self.device.name, self.drivers_sent, self.drivers_suppressed, self.drivers_filtered, self.command_queue.sent, self.command_queue.coalesced))
+        self.command_queue.cancel()
+        self._disconnect()
+
+
+class DysonPureFan(DysonNode):
+    aggregated = True
+
+    @classmethod
+    def load_product(cls):
+        from libpurecool.dyson_pure_cool import DysonPureCool
+        from libpurecool.dyson_pure_state_v2 import DysonPureCoolV2State, DysonEnvironmentalSensorV2State
+        cls.device_class, cls.state_message, cls.env_message = DysonPureCool, DysonPureCoolV2State, DysonEnvironmentalSensorV2State
+        return {DysonPureCoolV2State: v2_state_map(), DysonEnvironmentalSensorV2State: V2_ENV_MAP}
+
+    def __init__(self, controller, primary, address, name, device):
+        super().__init__(controller, primary, address, name, device)
+        self.history = SensorHistory(('pm25', 'pm10'), controller.history_window)
+
+    def on_message(self, msg):
+        super().on_message(msg)
+        if isinstance(msg, self.env_message):
+            self.update_history(msg)
 
     def updateInfo(self):
-        LOGGER.debug(self.device.state)
-        LOGGER.debug(self.device.environmental_state)
-        if self.device.state.fan_power == FanPower.POWER_ON.value:
-            if self.device.state.auto_mode == AutoMode.AUTO_ON.value:
-                self.setDriver('ST', 11)
-            else:
-                self.setDriver('ST', int(self.device.state.speed))
-        else:
-            self.setDriver('ST', 0)
-        temp = float(self.device.environmental_state.temperature)
-        tempC = round(temp - 273.15, 2)
-        tempF = round(temp * 9 / 5 - 459.67, 2)
-        self.setDriver('CLITEMP', tempC)
-        self.setDriver('GV0', tempF)
-        self.setDriver('CLIHUM', int(self.device.environmental_state.humidity))
-        self.setDriver('GV1', int(self.device.environmental_state.particulate_matter_25))
-        self.setDriver('GV2', int(self.device.environmental_state.particulate_matter_10))
-        self.setDriver('VOCLVL', int(self.device.environmental_state.volatile_organic_compounds))
-        self.setDriver('GV3', int(self.device.environmental_state.nitrogen_dioxide))
-        if self.device.state.oscillation == OscillationV2.OSCILLATION_ON.value:
-            self.setDriver('GV4', 1)
-        else:
-            self.setDriver('GV4', 0)
-        if self.device.state.front_direction == FrontalDirection.FRONTAL_ON.value:
-            self.setDriver('AIRFLOW', 0)
-        else:
-            self.setDriver('AIRFLOW', 1)
-        if self.device.state.night_mode == 'ON':
-            self.setDriver('GV5', 1)
-        else:
-            self.setDriver('GV5', 0)
-        self.setDriver('GV6', int(self.device.state.oscillation_angle_low))
-        self.setDriver('GV7', int(self.device.state.oscillation_angle_high))
-        self.setDriver('GV8', int(self.device.state.carbon_filter_state))
-        self.setDriver('GV9', int(self.device.state.hepa_filter_state))
-        self.setDriver('GV10', int(self.device.environmental_state.sleep_timer))
-
-    def query(self):
-        self.reportDrivers()
+        super().updateInfo()
+        self.update_history(self.device.environmental_state)
+
+    def update_history(self, msg):
+        if not self.history.add(time.time(), {'pm25': int(msg.particulate_matter_25), 'pm10': int(msg.particulate_matter_10)}):
+            return
+        pm25 = self.history.mean('pm25')
+        pm10 = self.history.mean('pm10')
+        self.setDriver('GV13', round(pm25, 1))
+        self.setDriver('GV14', round(pm10, 1))
+        self.setDriver('GV15', int(self.history.max('pm25')))
+        self.setDriver('GV16', max(_aqi(pm25, PM25_AQI, 10), _aqi(pm10, PM10_AQI, 1)))
+
+    def _speed_when_on(self):
+        state = self.device.state
+        if state is None:
+            return None
+        if state.auto_mode == const.AutoMode.AUTO_ON.value:
+            return 11
+        try:
+            return int(state.speed)
+        except ValueError:
+            return None
 
     def set_on(self, command):
-        self.device.turn_on()
+        self.expect('fan', ST=self._speed_when_on())
+        self.command_queue.submit('fan', self.device.turn_on)
 
     def set_off(self, command):
-        self.device.turn_off()
+        self.expect('fan', ST=0)
+        self.command_queue.submit('fan', self.device.turn_off)
 
     def set_speed(self, command):
         speed = int(command.get('value'))
         if speed < 0 or speed > 11:
             LOGGER.error('Invalid speed selection {}'.format(speed))
-        elif speed == 0:
-            self.device.turn_off()
+            return
+        self.expect('fan', ST=speed)
+        if speed == 0:
+            self.command_queue.submit('fan', self.device.turn_off, debounce=True)
         elif speed == 11:
-            self.device.enable_auto_mode()
+            self.command_queue.submit('fan', self.device.enable_auto_mode, debounce=True)
         else:
-            self.device.set_fan_speed(FanSpeed("%04d" % speed))
+            self.command_queue.submit('fan', self.device.set_fan_speed, const.FanSpeed("%04d" % speed), debounce=True)
 
     def set_off_timer(self, command):
         timer = int(command.get('value'))
         if timer == 0:
-            self.device.disable_sleep_timer()
+            self.command_queue.submit('sleep_timer', self.device.disable_sleep_timer, debounce=True)
         else:
-            try:
-                self.device.enable_sleep_timer(timer)
-            except Exception as ex:
-                LOGGER.error('Invalid timer value: {}'.format(ex))
+            self.command_queue.submit('sleep_timer', self.device.enable_sleep_timer, timer, debounce=True)
 
     def set_auto(self, command):
-        self.device.enable_auto_mode()
+        self.expect('fan', ST=11)
+        self.command_queue.submit('fan', self.device.enable_auto_mode)
 
     def set_oscillation(self, command):
         osc = int(command.get('value'))
         if osc == 0:
-            self.device.disable_oscillation()
-        elif osc == 45:
-            self.device.enable_oscillation(157, 202)
-        elif osc == 90:
-            self.device.enable_oscillation(135, 225)
-        elif osc == 180:
-            self.device.enable_oscillation(90, 270)
-        elif osc == 350:
-            self.device.enable_oscillation(5, 355)
+            self.expect('oscillation', GV4=0)
+            self.command_queue.submit('oscillation', self.device.disable_oscillation)
+        elif osc in OSCILLATION_ANGLES:
+            low, high = OSCILLATION_ANGLES[osc]
+            self.expect('oscillation', GV4=1, GV6=low, GV7=high)
+            self.command_queue.submit('oscillation', self.device.enable_oscillation, low, high)
         else:
             LOGGER.error('Invalid oscillation angle')
 
@@ -247,22 +2261,24 @@ class DysonPureFan(polyinterface.Node):
         query = command.get('query')
         oscstart = int(query.get('L.uom14'))
         oscstop = int(query.get('H.uom14'))
-        try:
-            self.device.enable_oscillation(oscstart, oscstop)
-        except Exception as ex:
-            LOGGER.error('Invalid oscillation angle selection: {}'.format(ex))
+        self.expect('oscillation', GV4=1, GV6=oscstart, GV7=oscstop)
+        self.command_queue.submit('oscillation', self.device.enable_oscillation, oscstart, oscstop, debounce=True)
 
     def set_airflow_fwd(self, command):
-        self.device.enable_frontal_direction()
+        self.expect('airflow', AIRFLOW=0)
+        self.command_queue.submit('airflow', self.device.enable_frontal_direction)
 
     def set_airflow_rew(self, command):
-        self.device.disable_frontal_direction()
+        self.expect('airflow', AIRFLOW=1)
+        self.command_queue.submit('airflow', self.device.disable_frontal_direction)
 
     def set_night_off(self, command):
-        self.device.disable_night_mode()
+        self.expect('night_mode', GV5=0)
+        self.command_queue.submit('night_mode', self.device.disable_night_mode)
 
     def set_night_on(self, command):
-        self.device.enable_night_mode()
+        self.expect('night_mode', GV5=1)
+        self.command_queue.submit('night_mode', self.device.enable_night_mode)
 
     drivers = [{'driver': 'ST', 'value': 0, 'uom': 25},
                {'driver': 'CLITEMP', 'value': 0, 'uom': 4},
@@ -279,150 +2295,52 @@ class DysonPureFan(polyinterface.Node):
                {'driver': 'GV7', 'value': 0, 'uom': 14},
                {'driver': 'GV8', 'value': 0, 'uom': 51},
                {'driver': 'GV9', 'value': 0, 'uom': 51},
-               {'driver': 'GV10', 'value': 0, 'uom': 45}
+               {'driver': 'GV10', 'value': 0, 'uom': 45},
+               {'driver': 'GV12', 'value': 0, 'uom': 2},
+               {'driver': 'GV13', 'value': 0, 'uom': 56},
+               {'driver': 'GV14', 'value': 0, 'uom': 56},
+               {'driver': 'GV15', 'value': 0, 'uom': 56},
+               {'driver': 'GV16', 'value': 0, 'uom': 56},
+               {'driver': 'GV17', 'value': 0, 'uom': 2}
               ]
 
     id = 'DYPFAN'
 
     commands = {
-            'QUERY': query, 'DON': set_on, 'DOF': set_off, 'SPEED': set_speed, 'OFFTMR': set_off_timer, 'AUTO': set_auto, 'ROTATE': set_oscillation,
+            'QUERY': DysonNode.query, 'DON': set_on, 'DOF': set_off, 'SPEED': set_speed, 'OFFTMR': set_off_timer, 'AUTO': set_auto, 'ROTATE': set_oscillation,
             'ANGLE': set_osc_angle, 'AFFWD': set_airflow_fwd, 'AFREW': set_airflow_rew, 'NIGHTON': set_night_on, 'NIGHTOFF': set_night_off
                }
 
 
 class DysonPureHeatFan(DysonPureFan):
+    @classmethod
+    def load_product(cls):
+        from libpurecool.dyson_pure_hotcool import DysonPureHotCool
+        from libpurecool.dyson_pure_state_v2 import DysonPureHotCoolV2State, DysonEnvironmentalSensorV2State
+        cls.device_class, cls.state_message, cls.env_message = DysonPureHotCool, DysonPureHotCoolV2State, DysonEnvironmentalSensorV2State
+        return {DysonPureHotCoolV2State: hot_cool_state_map(), DysonEnvironmentalSensorV2State: V2_ENV_MAP}
+
     def __init__(self, controller, primary, address, name, device):
         super().__init__(controller, primary, address, name, device)
         self.device = device
 
-    def on_message(self, msg):
-        if isinstance(msg, DysonPureHotCoolV2State):
-            LOGGER.debug('Received State message for {}'.format(self.device.name))
-            if msg.fan_power == FanPower.POWER_ON.value:
-                if msg.auto_mode == AutoMode.AUTO_ON.value:
-                    self.setDriver('ST', 11)
-                else:
-                    self.setDriver('ST', int(msg.speed))
-            else:
-                self.setDriver('ST', 0)
-            if msg.oscillation == OscillationV2.OSCILLATION_ON.value:
-                self.setDriver('GV4', 1)
-            else:
-                self.setDriver('GV4', 0)
-            if msg.front_direction == FrontalDirection.FRONTAL_ON.value:
-                self.setDriver('AIRFLOW', 0)
-            else:
-                self.setDriver('AIRFLOW', 1)
-            if msg.night_mode == 'ON':
-                self.setDriver('GV5', 1)
-            else:
-                 self.setDriver('GV5', 0)
-            self.setDriver('GV6', int(msg.oscillation_angle_low))
-            self.setDriver('GV7', int(msg.oscillation_angle_high))
-            self.setDriver('GV8', int(msg.carbon_filter_state))
-            self.setDriver('GV9', int(msg.hepa_filter_state))
-            # these are Heater Specific
-            if msg.tilt == TiltState.TILT_TRUE.value:
-                self.setDriver('GV11', 1)
-            else:
-                self.setDriver('GV11', 0)
-            if msg.heat_mode == HeatMode.HEAT_ON.value:
-                self.setDriver('CLIMD', 1)
-            else:
-                self.setDriver('CLIMD', 0)
-            if msg.heat_state == HeatState.HEAT_STATE_ON.value:
-                self.setDriver('CLIHCS', 1)
-            else:
-                self.setDriver('CLIHCS', 0)
-            heat_sp = float(msg.heat_target) / 10
-            heat_sp_f = round((heat_sp - 273.15) * 9 / 5 + 32)
-            # heat_sp_c = round(heat_sp - 273.15)
-            self.setDriver('CLISPH', heat_sp_f)
-        elif isinstance(msg, DysonEnvironmentalSensorV2State):
-            LOGGER.debug('Received Environmental State message for {}'.format(self.device.name))
-            temp = float(msg.temperature)
-            tempC = round(temp - 273.15, 2)
-            tempF = round(temp * 9 / 5 - 459.67, 2)
-            self.setDriver('CLITEMP', tempC)
-            self.setDriver('GV0', tempF)
-            self.setDriver('CLIHUM', int(msg.humidity))
-            self.setDriver('GV1', int(msg.particulate_matter_25))
-            self.setDriver('GV2', int(msg.particulate_matter_10))
-            self.setDriver('VOCLVL', int(msg.volatile_organic_compounds))
-            self.setDriver('GV3', int(msg.nitrogen_dioxide))
-            self.setDriver('GV10', int(msg.sleep_timer))
-        else:
-            LOGGER.warning('Unknown message received for {}'.format(self.device.name))
-        LOGGER.debug('Received message {}'.format(str(msg)))
-
-    def updateInfo(self):
-        LOGGER.debug(self.device.state)
-        LOGGER.debug(self.device.environmental_state)
-        if self.device.state.fan_power == FanPower.POWER_ON.value:
-            if self.device.state.auto_mode == AutoMode.AUTO_ON.value:
-                self.setDriver('ST', 11)
-            else:
-                self.setDriver('ST', int(self.device.state.speed))
-        else:
-            self.setDriver('ST', 0)
-        temp = float(self.device.environmental_state.temperature)
-        tempC = round(temp - 273.15, 2)
-        tempF = round(temp * 9 / 5 - 459.67, 2)
-        self.setDriver('CLITEMP', tempC)
-        self.setDriver('GV0', tempF)
-        self.setDriver('CLIHUM', int(self.device.environmental_state.humidity))
-        self.setDriver('GV1', int(self.device.environmental_state.particulate_matter_25))
-        self.setDriver('GV2', int(self.device.environmental_state.particulate_matter_10))
-        self.setDriver('VOCLVL', int(self.device.environmental_state.volatile_organic_compounds))
-        self.setDriver('GV3', int(self.device.environmental_state.nitrogen_dioxide))
-        if self.device.state.oscillation == OscillationV2.OSCILLATION_ON.value:
-            self.setDriver('GV4', 1)
-        else:
-            self.setDriver('GV4', 0)
-        if self.device.state.front_direction == FrontalDirection.FRONTAL_ON.value:
-            self.setDriver('AIRFLOW', 0)
-        else:
-            self.setDriver('AIRFLOW', 1)
-        if self.device.state.night_mode == 'ON':
-            self.setDriver('GV5', 1)
-        else:
-            self.setDriver('GV5', 0)
-        self.setDriver('GV6', int(self.device.state.oscillation_angle_low))
-        self.setDriver('GV7', int(self.device.state.oscillation_angle_high))
-        self.setDriver('GV8', int(self.device.state.carbon_filter_state))
-        self.setDriver('GV9', int(self.device.state.hepa_filter_state))
-        self.setDriver('GV10', int(self.device.environmental_state.sleep_timer))
-        if self.device.state.tilt == TiltState.TILT_TRUE.value:
-            self.setDriver('GV11', 1)
-        else:
-            self.setDriver('GV11', 0)
-
-        if self.device.state.heat_mode == HeatMode.HEAT_ON.value:
-            self.setDriver('CLIMD', 1)
-        else:
-            self.setDriver('CLIMD', 0)
-        if self.device.state.heat_state == HeatState.HEAT_STATE_ON.value:
-            self.setDriver('CLIHCS', 1)
-        else:
-            self.setDriver('CLIHCS', 0)
-        heat_sp = float(self.device.state.heat_target) / 10
-        heat_sp_f = round((heat_sp - 273.15) * 9 / 5 + 32)
-        # heat_sp_c = round(heat_sp - 273.15)
-        self.setDriver('CLISPH', heat_sp_f)
-
     def set_point_heat(self, command):
         heat_sp = int(command.get('value'))
         if 34 <= heat_sp <= 98:
-            self.device.set_heat_target(HeatTarget.fahrenheit(heat_sp))
+            target = const.HeatTarget.fahrenheit(heat_sp)
+            # the device works in whole kelvins, expect the setpoint it will report back
+            self.expect('heat_target', CLISPH=_heat_target_to_f(target))
+            self.command_queue.submit('heat_target', self.device.set_heat_target, target, debounce=True)
         else:
             LOGGER.error(f'Invalid Heat Setpoint: {heat_sp}')
 
     def set_heat_mode(self, command):
         heat_mode = int(command.get('value'))
+        self.expect('heat_mode', CLIMD=1 if heat_mode == 1 else 0)
         if heat_mode == 1:
-            self.device.enable_heat_mode()
+            self.command_queue.submit('heat_mode', self.device.enable_heat_mode)
         else:
-            self.device.disable_heat_mode()
+            self.command_queue.submit('heat_mode', self.device.disable_heat_mode)
 
     drivers = [{'driver': 'ST', 'value': 0, 'uom': 25},
                {'driver': 'CLITEMP', 'value': 0, 'uom': 4},
@@ -443,7 +2361,13 @@ class DysonPureHeatFan(DysonPureFan):
                {'driver': 'GV11', 'value': 0, 'uom': 2},
                {'driver': 'CLISPH', 'value': 0, 'uom': 17},
                {'driver': 'CLIMD', 'value': 0, 'uom': 67},
-               {'driver': 'CLIHCS', 'value': 0, 'uom': 66}
+               {'driver': 'CLIHCS', 'value': 0, 'uom': 66},
+               {'driver': 'GV12', 'value': 0, 'uom': 2},
+               {'driver': 'GV13', 'value': 0, 'uom': 56},
+               {'driver': 'GV14', 'value': 0, 'uom': 56},
+               {'driver': 'GV15', 'value': 0, 'uom': 56},
+               {'driver': 'GV16', 'value': 0, 'uom': 56},
+               {'driver': 'GV17', 'value': 0, 'uom': 2}
               ]
 
     id = 'DYPHFAN'
@@ -454,183 +2378,92 @@ class DysonPureHeatFan(DysonPureFan):
             'CLISPH': set_point_heat, 'CLIMD': set_heat_mode
                }
 
-class DysonPureFanV1(polyinterface.Node):
-    def __init__(self, controller, primary, address, name, device):
-        super().__init__(controller, primary, address, name)
-        self.device = device
-
-    def start(self):
-        LOGGER.info('Starting {}'.format(self.device.name))
-        self._connect()
-        self.updateInfo()
-        self.device.add_message_listener(self.on_message)
-
-    def _connect(self):
-        if self.controller.devlist:
-            LOGGER.info('Looking for device IP in the devlist...')
-            for dev in self.controller.devlist:
-                if 'sn' not in dev or 'ip' not in dev:
-                    LOGGER.error('Invalid entry: {}'.format(dev))
-                else:
-                    if dev['sn'] == self.address:
-                        LOGGER.info('Found IP {} for SN {}'.format(dev['ip'], dev['sn']))
-                        self.device.connect(dev['ip'])
-                        return
-        LOGGER.info('Trying auto connect...')
-        self.device.auto_connect()
-
-    def on_message(self, msg):
-        if isinstance(msg, DysonPureCoolState):
-            LOGGER.debug('Received v1 State message for {}'.format(self.device.name))
-            if msg.fan_state == FanState.FAN_ON.value:
-                if msg.fan_mode == FanMode.AUTO.value:
-                    self.setDriver('ST', 11)
-                else:
-                    self.setDriver('ST', int(msg.speed))
-            else:
-                self.setDriver('ST', 0)
-            if msg.oscillation == Oscillation.OSCILLATION_ON.value:
-                self.setDriver('GV4', 1)
-            else:
-                self.setDriver('GV4', 0)
-            if msg.night_mode == 'ON':
-                self.setDriver('GV5', 1)
-            else:
-                 self.setDriver('GV5', 0)
-            if msg.quality_target == QualityTarget.QUALITY_NORMAL.value:
-                self.setDriver('GV6', 1)
-            elif msg.quality_target == QualityTarget.QUALITY_BETTER.value:
-                self.setDriver('GV6', 2)
-            elif msg.quality_target == QualityTarget.QUALITY_HIGH.value:
-                self.setDriver('GV6', 3)
-            else:
-                self.setDriver('GV6', 0)
-            if msg.standby_monitoring == StandbyMonitoring.STANDBY_MONITORING_ON.value:
-                self.setDriver('GV7', 1)
-            else:
-                self.setDriver('GV7', 0)
-            self.setDriver('GV8', int(msg.filter_life))
-        elif isinstance(msg, DysonEnvironmentalSensorState):
-            LOGGER.debug('Received v1 Environmental State message for {}'.format(self.device.name))
-            temp = float(msg.temperature)
-            tempC = round(temp - 273.15, 2)
-            tempF = round(temp * 9 / 5 - 459.67, 2)
-            self.setDriver('CLITEMP', tempC)
-            self.setDriver('GV0', tempF)
-            self.setDriver('CLIHUM', int(msg.humidity))
-            self.setDriver('GV1', int(msg.dust))
-            self.setDriver('VOCLVL', int(msg.volatil_organic_compounds))
-            self.setDriver('GV10', int(msg.sleep_timer))
-        else:
-            LOGGER.warning('Unknown message received for {}'.format(self.device.name))
-        LOGGER.debug('Received message {}'.format(str(msg)))
-
-    def stop(self):
-        LOGGER.info('Stopping {}'.format(self.device.name))
-        self.device.disconnect()
-
-    def updateInfo(self):
-        LOGGER.debug(self.device.state)
-        LOGGER.debug(self.device.environmental_state)
-        if self.device.state.fan_state == FanState.FAN_ON.value:
-            if self.device.state.fan_mode == FanMode.AUTO.value:
-                self.setDriver('ST', 11)
-            else:
-                self.setDriver('ST', int(self.device.state.speed))
-        else:
-            self.setDriver('ST', 0)
-        temp = float(self.device.environmental_state.temperature)
-        tempC = round(temp - 273.15, 2)
-        tempF = round(temp * 9 / 5 - 459.67, 2)
-        self.setDriver('CLITEMP', tempC)
-        self.setDriver('GV0', tempF)
-        self.setDriver('CLIHUM', int(self.device.environmental_state.humidity))
-        self.setDriver('GV1', int(self.device.environmental_state.dust))
-        self.setDriver('VOCLVL', int(self.device.environmental_state.volatil_organic_compounds))
-        if self.device.state.oscillation == Oscillation.OSCILLATION_ON.value:
-            self.setDriver('GV4', 1)
-        else:
-            self.setDriver('GV4', 0)
-        if self.device.state.night_mode == 'ON':
-            self.setDriver('GV5', 1)
-        else:
-            self.setDriver('GV5', 0)
-        self.setDriver('GV8', int(self.device.state.filter_life))
-        self.setDriver('GV10', int(self.device.environmental_state.sleep_timer))
-        if self.device.state.quality_target == QualityTarget.QUALITY_NORMAL.value:
-            self.setDriver('GV6', 1)
-        elif self.device.state.quality_target == QualityTarget.QUALITY_BETTER.value:
-            self.setDriver('GV6', 2)
-        elif self.device.state.quality_target == QualityTarget.QUALITY_HIGH.value:
-            self.setDriver('GV6', 3)
-        else:
-            self.setDriver('GV6', 0)
-        if self.device.state.standby_monitoring == StandbyMonitoring.STANDBY_MONITORING_ON.value:
-            self.setDriver('GV7', 1)
-        else:
-            self.setDriver('GV7', 0)
-
-    def query(self):
-        self.reportDrivers()
+class DysonPureFanV1(DysonNode):
+    @classmethod
+    def load_product(cls):
+        from libpurecool.dyson_pure_cool_link import DysonPureCoolLink
+        from libpurecool.dyson_pure_state import DysonPureCoolState, DysonEnvironmentalSensorState
+        cls.device_class, cls.state_message, cls.env_message = DysonPureCoolLink, DysonPureCoolState, DysonEnvironmentalSensorState
+        return {DysonPureCoolState: v1_state_map(), DysonEnvironmentalSensorState: V1_ENV_MAP}
+
+    def _configure(self, clear=(), debounce=False, **fields):
+        self.command_queue.merge('config', self.device.set_configuration, clear, debounce, **fields)
+
+    def _speed_when_on(self):
+        state = self.device.state
+        if state is None:
+            return None
+        try:
+            return int(state.speed)
+        except ValueError:
+            return None
 
     def set_on(self, command):
-        self.device.set_configuration(fan_mode=FanMode.FAN)
+        self.expect('config', ST=self._speed_when_on())
+        self._configure(clear=('fan_speed',), fan_mode=const.FanMode.FAN)
 
     def set_off(self, command):
-        self.device.set_configuration(fan_mode=FanMode.OFF)
+        self.expect('config', ST=0)
+        self._configure(clear=('fan_speed',), fan_mode=const.FanMode.OFF)
 
     def set_speed(self, command):
         speed = int(command.get('value'))
         if speed < 0 or speed > 11:
             LOGGER.error('Invalid speed selection {}'.format(speed))
-        elif speed == 0:
-            self.device.set_configuration(fan_mode=FanMode.OFF)
+            return
+        self.expect('config', ST=speed)
+        if speed == 0:
+            self._configure(clear=('fan_speed',), debounce=True, fan_mode=const.FanMode.OFF)
         elif speed == 11:
-            self.device.set_configuration(fan_mode=FanMode.AUTO)
+            self._configure(clear=('fan_speed',), debounce=True, fan_mode=const.FanMode.AUTO)
         else:
-            self.device.set_configuration(fan_speed=FanSpeed("%04d" % speed))
+            self._configure(clear=('fan_mode',), debounce=True, fan_speed=const.FanSpeed("%04d" % speed))
 
     def set_off_timer(self, command):
         timer = int(command.get('value'))
-        try:
-            self.device.set_configuration(sleep_timer=timer)
-        except Exception as ex:
-            LOGGER.error('Invalid timer value: {}'.format(ex))
+        self._configure(debounce=True, sleep_timer=timer)
 
     def set_auto(self, command):
-        self.device.set_configuration(fan_mode=FanMode.AUTO)
+        self.expect('config', ST=11)
+        self._configure(clear=('fan_speed',), fan_mode=const.FanMode.AUTO)
 
     def set_oscillation_on(self, command):
-        self.device.set_configuration(oscillation=Oscillation.OSCILLATION_ON)
+        self.expect('config', GV4=1)
+        self._configure(oscillation=const.Oscillation.OSCILLATION_ON)
 
     def set_oscillation_off(self, command):
-        self.device.set_configuration(oscillation=Oscillation.OSCILLATION_OFF)
+        self.expect('config', GV4=0)
+        self._configure(oscillation=const.Oscillation.OSCILLATION_OFF)
 
     def set_standby_mon_on(self, command):
-        self.device.set_configuration(standby_monitoring=StandbyMonitoring.STANDBY_MONITORING_ON)
+        self.expect('config', GV7=1)
+        self._configure(standby_monitoring=const.StandbyMonitoring.STANDBY_MONITORING_ON)
 
     def set_standby_mon_off(self, command):
-        self.device.set_configuration(standby_monitoring=StandbyMonitoring.STANDBY_MONITORING_OFF)
+        self.expect('config', GV7=0)
+        self._configure(standby_monitoring=const.StandbyMonitoring.STANDBY_MONITORING_OFF)
 
     def reset_filter_life(self, command):
-        self.device.set_configuration(reset_filter=ResetFilter.RESET_FILTER)
+        self._configure(reset_filter=const.ResetFilter.RESET_FILTER)
 
     def set_quality(self, command):
         quality = int(command.get('value'))
         if quality == 1:
-            self.device.set_configuration(quality_target=QualityTarget.QUALITY_NORMAL)
+            self._configure(quality_target=const.QualityTarget.QUALITY_NORMAL)
         elif quality == 2:
-            self.device.set_configuration(quality_target=QualityTarget.QUALITY_BETTER)
+            self._configure(quality_target=const.QualityTarget.QUALITY_BETTER)
         elif quality == 3:
-            self.device.set_configuration(quality_target=QualityTarget.QUALITY_BEST)
+            self._configure(quality_target=const.QualityTarget.QUALITY_BEST)
         else:
             LOGGER.error('Invalid quality value: {}'.format(quality))
 
     def set_night_off(self, command):
-        self.device.set_configuration(night_mode=NightMode.NIGHT_MODE_OFF)
+        self.expect('config', GV5=0)
+        self._configure(night_mode=const.NightMode.NIGHT_MODE_OFF)
 
     def set_night_on(self, command):
-        self.device.set_configuration(night_mode=NightMode.NIGHT_MODE_ON)
+        self.expect('config', GV5=1)
+        self._configure(night_mode=const.NightMode.NIGHT_MODE_ON)
 
     drivers = [{'driver': 'ST', 'value': 0, 'uom': 25},
                {'driver': 'CLITEMP', 'value': 0, 'uom': 4},
@@ -643,18 +2476,108 @@ class DysonPureFanV1(polyinterface.Node):
                {'driver': 'GV6', 'value': 0, 'uom': 25},
                {'driver': 'GV7', 'value': 0, 'uom': 2},
                {'driver': 'GV8', 'value': 0, 'uom': 20},
-               {'driver': 'GV10', 'value': 0, 'uom': 45}
+               {'driver': 'GV10', 'value': 0, 'uom': 45},
+               {'driver': 'GV12', 'value': 0, 'uom': 2}
               ]
 
     id = 'DYPFANV1'
 
     commands = {
-            'QUERY': query, 'DON': set_on, 'DOF': set_off, 'SPEED': set_speed, 'OFFTMR': set_off_timer, 'AUTO': set_auto, 'OSCON': set_oscillation_on,
+            'QUERY': DysonNode.query, 'DON': set_on, 'DOF': set_off, 'SPEED': set_speed, 'OFFTMR': set_off_timer, 'AUTO': set_auto, 'OSCON': set_oscillation_on,
             'OSCOFF': set_oscillation_off, 'NIGHTON': set_night_on, 'NIGHTOFF': set_night_off, 'STBYON': set_standby_mon_on, 'STBYOFF': set_standby_mon_off,
             'RSTFLT': reset_filter_life, 'SETQAL': set_quality
                }
 
 
+class DysonGroup(polyinterface.Node):
+    """
+    Sends each command to all member fans at once and reports how many of them took it.
+    members lists serial numbers, node addresses or names, None stands for every fan.
+    """
+    def __init__(self, controller, primary, address, name, members):
+        super().__init__(controller, primary, address, name)
+        self.members = members
+        self.last_result = {}
+
+    def member_nodes(self):
+        nodes = list(self.controller.fan_nodes().values())
+        if self.members is None:
+            return nodes
+        wanted = set(member.lower() for member in self.members)
+        found = [node for node in nodes if wanted & {node.address, node.device.serial.lower(), node.name.lower()}]
+        if len(found) < len(wanted):
+            LOGGER.debug('Group {} has {} of {} member(s)'.format(self.name, len(found), len(wanted)))
+        return found
+
+    def _send(self, node, command):
+        handler = node.commands.get(command.get('cmd'))
+        if handler is None:
+            return 'unsupported'
+        if not node.connected:
+            return 'offline'
+        queue = node.command_queue
+        failed = queue.failed
+        handler(node, command)
+        # a group command carries the final value, debounced commands go out right away
+        queue.flush()
+        return 'ok' if queue.failed == failed else 'failed'
+
+    def run(self, command):
+        nodes = self.member_nodes()
+        futures = {self.controller.group_executor.submit(self._send, node, command): node for node in nodes}
+        # results are collected off Polyglot's input thread, which would otherwise wait up to GROUP_TIMEOUT
+        threading.Thread(target=self._report, args=(command, nodes, futures), name='DysonGroupResult', daemon=True).start()
+
+    def _report(self, command, nodes, futures):
+        done, not_done = wait(futures, timeout=GROUP_TIMEOUT)
+        result = {}
+        for future, node in futures.items():
+            if future in not_done:
+                result[node.name] = 'timeout'
+            elif future.exception() is not None:
+                LOGGER.error('Group {} command {} failed for {}: {}'.format(self.name, command.get('cmd'), node.name, future.exception()))
+                result[node.name] = 'failed'
+            else:
+                result[node.name] = future.result()
+        self.last_result = result
+        ok = sum(1 for value in result.values() if value == 'ok')
+        failed = sum(1 for value in result.values() if value not in ('ok', 'unsupported'))
+        problems = ', '.join('{} {}'.format(name, value) for name, value in sorted(result.items()) if value != 'ok')
+        LOGGER.info('Group {} command {}: {} of {} member(s) ok{}'.format(self.name, command.get('cmd'), ok, len(result), ', ' + problems if problems else ''))
+        self.setDriver('GV0', len(nodes))
+        self.setDriver('GV1', ok)
+        self.setDriver('GV2', failed)
+
+    def query(self, command=None):
+        self.setDriver('GV0', len(self.member_nodes()))
+        self.reportDrivers()
+
+    def stop(self):
+        pass
+
+    drivers = [{'driver': 'GV0', 'value': 0, 'uom': 56},
+               {'driver': 'GV1', 'value': 0, 'uom': 56},
+               {'driver': 'GV2', 'value': 0, 'uom': 56}
+              ]
+
+    id = 'DYSONGRP'
+
+    commands = {
+            'QUERY': query, 'DON': run, 'DOF': run, 'SPEED': run, 'AUTO': run, 'CLISPH': run, 'NIGHTON': run, 'NIGHTOFF': run
+               }
+
+
+# product types from libpurecool.const, node classes import their libpurecool modules on first use
+PRODUCTS = {
+    '438': DysonPureFan,  # DYSON_PURE_COOL
+    '520': DysonPureFan,  # DYSON_PURE_COOL_DESKTOP
+    '358': DysonPureFan,  # DYSON_PURE_COOL_HUMIDIFY
+    '527': DysonPureHeatFan,  # DYSON_PURE_HOT_COOL
+    '475': DysonPureFanV1  # DYSON_PURE_COOL_LINK_TOUR
+}
+STARTUP_TIMES['load dyson-poly'] = time.perf_counter() - POLYINTERFACE_LOADED
+
+
 if __name__ == "__main__":
     try:
         polyglot = polyinterface.Interface('Dyson')
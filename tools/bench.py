@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of the message to driver path. Replays synthetic state and environmental
+messages across simulated nodes and reports throughput, per message latency, setDriver
+calls, published driver updates and allocations.
+
+    python3 tools/bench.py --v2 10 --hotcool 5 --v1 5 --messages 2000
+    python3 tools/bench.py --v2 20 --rate 2 --duration 30 --dispatch
+"""
+import os
+import sys
+import json
+import time
+import heapq
+import argparse
+import itertools
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakes
+
+
+def percentiles(samples, points=(50, 90, 99, 99.9)):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    result = {'p{:g}'.format(p): samples[min(len(samples) - 1, int(len(samples) * p / 100))] for p in points}
+    result['max'] = samples[-1]
+    result['mean'] = sum(samples) / len(samples)
+    return result
+
+
+class SetDriverCounter(object):
+    """
+    Counts setDriver calls on every node class, safe to use from the dispatcher threads
+    """
+    def __init__(self, server):
+        self.server = server
+        self.counter = itertools.count()
+        self.calls = 0
+        self.original = server.DysonNode.setDriver
+
+    def __enter__(self):
+        original = self.original
+        counter = self.counter
+
+        def setDriver(node, *args, **kwargs):
+            next(counter)
+            return original(node, *args, **kwargs)
+        self.server.DysonNode.setDriver = setDriver
+        return self
+
+    def __exit__(self, *exc):
+        self.server.DysonNode.setDriver = self.original
+        self.calls = next(self.counter)
+
+
+def build_schedule(fleet, messages, rate, duration, env_ratio):
+    """
+    Pre-generates (due, seq, node index, message) tuples so message building is not timed.
+    Without a rate every node gets the same number of messages, interleaved.
+    """
+    schedule = []
+    seq = 0
+    for idx, (device, factory) in enumerate(fleet):
+        if rate > 0:
+            count = int(rate * duration)
+            phase = factory.random.random() / rate
+            times = [phase + i / rate for i in range(count)]
+        else:
+            times = [0.0] * messages
+        for due in times:
+            schedule.append((due, seq, idx, factory.message(env_ratio)))
+            seq += 1
+    if rate <= 0:
+        schedule.sort(key=lambda item: (item[1] % messages, item[1]))
+    else:
+        heapq.heapify(schedule)
+        schedule = [heapq.heappop(schedule) for _ in range(len(schedule))]
+    return schedule
+
+
+def replay(nodes, devices, schedule, rate, dispatch):
+    latencies = []
+    started = time.perf_counter()
+    for due, _, idx, msg in schedule:
+        if rate > 0:
+            delay = started + due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if dispatch:
+            devices[idx].emit(msg)
+        else:
+            t0 = time.perf_counter()
+            nodes[idx].process_message(msg)
+            latencies.append(time.perf_counter() - t0)
+    return latencies, time.perf_counter() - started
+
+
+def wait_dispatched(controller, submitted, timeout=60):
+    """
+    Waits until every submitted message was processed, collapsed or dropped
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        stats = controller.dispatcher.stats()
+        if stats['processed'] + stats['collapsed'] + stats['dropped'] >= submitted:
+            return
+        time.sleep(0.001)
+
+
+def run(args):
+    server = fakes.load_server(args.server)
+    fleet = fakes.make_fleet(server, {'v2': args.v2, 'hotcool': args.hotcool, 'v1': args.v1}, args.change, args.seed)
+    if not fleet:
+        sys.exit('No nodes to simulate')
+    params = dict(json.loads(args.params)) if args.params else {}
+    if args.dispatch:
+        params.setdefault('dispatch_queue', str(max(1024, len(fleet) * 4)))
+    controller, poly = fakes.start_controller(server, fleet, params)
+    devices = [device for device, _ in fleet]
+    by_serial = {node.device.serial: node for node in controller.fan_nodes().values()}
+    nodes = [by_serial[device.serial] for device in devices]
+    report = {'nodes': len(nodes), 'models': {'v2': args.v2, 'hotcool': args.hotcool, 'v1': args.v1}, 'mode': 'dispatch' if args.dispatch else 'direct'}
+
+    schedule = build_schedule(fleet, args.messages, args.rate, args.duration, args.env_ratio)
+    status_before = poly.status
+    started = time.perf_counter()
+    with SetDriverCounter(server) as counter:
+        latencies, elapsed = replay(nodes, devices, schedule, args.rate, args.dispatch)
+        if args.dispatch:
+            wait_dispatched(controller, len(schedule))
+            elapsed = time.perf_counter() - started
+    set_driver_calls = counter.calls
+    published = poly.status - status_before
+    report['messages'] = len(schedule)
+    report['elapsed_s'] = elapsed
+    report['throughput_msg_s'] = len(schedule) / elapsed if elapsed else 0
+    report['latency_us'] = {k: v * 1e6 for k, v in percentiles(latencies).items()}
+    if args.dispatch:
+        stats = controller.dispatcher.stats()
+        report['dispatch'] = stats
+        # collapsed and dropped messages were never applied, only processed ones count as throughput
+        report['offered_msg_s'] = report['throughput_msg_s']
+        report['throughput_msg_s'] = stats['processed'] / elapsed if elapsed else 0
+        report['processing_ms'] = server.LatencyHistogram.merged(node.metrics.processing for node in nodes).to_dict()
+    report['set_driver_calls'] = set_driver_calls
+    report['set_driver_per_msg'] = set_driver_calls / len(schedule)
+    report['published'] = published
+    report['published_per_msg'] = published / len(schedule)
+
+    timings = []
+    for node in nodes:
+        for _ in range(args.update_info):
+            t0 = time.perf_counter()
+            with node.driver_batch():
+                node.updateInfo()
+            timings.append(time.perf_counter() - t0)
+    report['update_info_us'] = {k: v * 1e6 for k, v in percentiles(timings).items()}
+
+    if args.allocations:
+        sample = build_schedule(fleet, min(args.messages, 200), 0, 0, args.env_ratio)
+        tracemalloc.start(args.frames)
+        before = tracemalloc.take_snapshot()
+        replay(nodes, devices, sample, 0, False)
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        flt = [tracemalloc.Filter(True, os.path.abspath(args.server))]
+        diff = after.filter_traces(flt).compare_to(before.filter_traces(flt), 'lineno')
+        blocks = sum(stat.count_diff for stat in diff if stat.count_diff > 0)
+        report['allocations'] = {
+            'messages': len(sample), 'traced_peak_kib': peak / 1024, 'retained_kib': sum(stat.size_diff for stat in diff) / 1024,
+            'retained_blocks_per_msg': blocks / len(sample),
+            'top': ['{}:{} {:+.1f} KiB {:+d} blocks'.format(os.path.basename(stat.traceback[0].filename), stat.traceback[0].lineno, stat.size_diff / 1024, stat.count_diff)
+                    for stat in diff[:args.top] if stat.size_diff]
+        }
+    controller.stop()
+    return report
+
+
+def print_report(report):
+    print('nodes: {nodes} (v2 {v2}, hotcool {hotcool}, v1 {v1}), mode: {mode}'.format(nodes=report['nodes'], mode=report['mode'], **report['models']))
+    if 'offered_msg_s' in report:
+        print('messages: {messages} offered in {elapsed_s:.3f}s, offered load {offered_msg_s:.0f} msg/s'.format(**report))
+        print('dispatch: processed {processed} ({rate:.0f} msg/s), collapsed {collapsed}, dropped {dropped}'.format(rate=report['throughput_msg_s'], **report['dispatch']))
+    else:
+        print('messages: {messages} in {elapsed_s:.3f}s, {throughput_msg_s:.0f} msg/s'.format(**report))
+    if report['latency_us']:
+        print('latency us: ' + ', '.join('{} {:.1f}'.format(k, v) for k, v in report['latency_us'].items()))
+    if 'processing_ms' in report:
+        print('processing ms: mean {mean}, p50 {p50}, p95 {p95}, p99 {p99}, max {max}'.format(**report['processing_ms']))
+    print('setDriver calls: {set_driver_calls} ({set_driver_per_msg:.2f} per message)'.format(**report))
+    print('published updates: {published} ({published_per_msg:.2f} per message)'.format(**report))
+    print('updateInfo us: ' + ', '.join('{} {:.1f}'.format(k, v) for k, v in report['update_info_us'].items()))
+    if 'allocations' in report:
+        alloc = report['allocations']
+        print('allocations over {messages} messages: traced peak {traced_peak_kib:.1f} KiB, retained {retained_kib:.1f} KiB, {retained_blocks_per_msg:.2f} blocks per message'.format(**alloc))
+        for line in alloc['top']:
+            print('    ' + line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--v2', type=int, default=10, help='Pure Cool nodes')
+    parser.add_argument('--hotcool', type=int, default=5, help='Pure Hot+Cool nodes')
+    parser.add_argument('--v1', type=int, default=5, help='Pure Cool Link nodes')
+    parser.add_argument('--messages', type=int, default=1000, help='messages per node without --rate')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second per node, 0 replays as fast as possible')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to replay with --rate')
+    parser.add_argument('--env-ratio', type=float, default=0.8, help='share of environmental messages')
+    parser.add_argument('--change', type=float, default=0.3, help='chance of each field changing between messages')
+    parser.add_argument('--dispatch', action='store_true', help='deliver through the device listeners and message dispatcher')
+    parser.add_argument('--params', help='customParams JSON, for example {"deadband": "{\\"GV1\\": 2}"}')
+    parser.add_argument('--update-info', type=int, default=20, help='updateInfo calls per node')
+    parser.add_argument('--no-allocations', dest='allocations', action='store_false', help='skip the tracemalloc pass')
+    parser.add_argument('--frames', type=int, default=1, help='tracemalloc frames')
+    parser.add_argument('--top', type=int, default=8, help='allocation sites to list')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--server', default=fakes.SERVER, help='node server file to load')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
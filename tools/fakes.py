@@ -0,0 +1,304 @@
+"""
+Offline stand-ins for polyinterface and Dyson devices, so dyson-poly.py can be loaded
+and driven without Polyglot or real machines. State and environmental messages are real
+libpurecool state objects built from synthetic MQTT payloads.
+"""
+import sys
+import os
+import json
+import types
+import random
+import logging
+import tempfile
+import importlib.util
+from copy import deepcopy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER = os.path.join(ROOT, 'dyson-poly.py')
+
+V2_STATE = {'fpwr': 'ON', 'fdir': 'ON', 'auto': 'OFF', 'oscs': 'ON', 'oson': 'OION', 'nmod': 'OFF', 'rhtm': 'ON', 'fnst': 'FAN', 'ercd': 'NONE',
+            'wacd': 'NONE', 'nmdv': '0004', 'fnsp': '0005', 'bril': '0002', 'corf': 'ON', 'cflr': '0085', 'hflr': '0095', 'sltm': 'OFF',
+            'osal': '0045', 'osau': '0315', 'ancp': 'CUST', 'hmax': '2980', 'hmod': 'HEAT', 'hsta': 'OFF', 'tilt': 'OK'}
+V2_ENV = {'tact': '2950', 'hact': '0045', 'pm25': '0010', 'pm10': '0007', 'va10': '0004', 'noxl': '0001', 'p25r': '0011', 'p10r': '0010', 'sltm': 'OFF'}
+V1_STATE = {'fmod': 'FAN', 'fnst': 'FAN', 'fnsp': '0004', 'qtar': '0003', 'oson': 'ON', 'rhtm': 'ON', 'filf': '2000', 'ercd': 'NONE', 'nmod': 'OFF', 'wacd': 'NONE'}
+V1_ENV = {'tact': '2950', 'hact': '0045', 'pact': '0003', 'vact': '0002', 'sltm': 'OFF'}
+
+# product type per simulated model
+MODELS = {'v2': '438', 'hotcool': '527', 'v1': '475'}
+
+
+class FakeInterface(object):
+    """
+    Records what the node server would send to Polyglot
+    """
+    def __init__(self, params=None):
+        self.config = {'customParams': dict(params or {}), 'nodes': [], 'notices': {}}
+        self.status = 0
+        self.messages = []
+        self.keep = False
+        self.added = []
+        self.removed = []
+
+    def send(self, message):
+        if 'status' in message:
+            self.status += 1
+        if self.keep:
+            self.messages.append(message)
+
+    def addNode(self, node):
+        self.added.append(node.address)
+
+    def delNode(self, address):
+        self.removed.append(address)
+
+    def onConfig(self, callback):
+        pass
+
+    def onStop(self, callback):
+        pass
+
+    def saveCustomParams(self, params):
+        self.config['customParams'] = dict(params)
+
+    def addNotice(self, *args, **kwargs):
+        pass
+
+
+class Node(object):
+    drivers = []
+
+    def __init__(self, controller, primary, address, name):
+        self.controller = controller
+        self.parent = controller
+        self.primary = primary
+        self.address = address
+        self.name = name
+        self.drivers = deepcopy(self.drivers)
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None):
+        for d in self.drivers:
+            if d['driver'] == driver:
+                d['value'] = value
+                if uom is not None:
+                    d['uom'] = uom
+                if report:
+                    self.controller.poly.send({'status': {'address': self.address, 'driver': driver, 'value': str(value), 'uom': d['uom']}})
+                return
+
+    def getDriver(self, driver):
+        for d in self.drivers:
+            if d['driver'] == driver:
+                return d['value']
+        return None
+
+    def reportDrivers(self):
+        for d in self.drivers:
+            self.controller.poly.send({'status': {'address': self.address, 'driver': d['driver'], 'value': str(d['value']), 'uom': d['uom']}})
+
+    def reportCmd(self, command, value=None, uom=None):
+        pass
+
+    def query(self):
+        self.reportDrivers()
+
+    def start(self):
+        pass
+
+
+class Controller(Node):
+    def __init__(self, poly, name='Controller'):
+        self.controller = self
+        self.parent = self
+        self.poly = poly
+        self.name = name
+        self.address = 'controller'
+        self.primary = self.address
+        self.drivers = deepcopy(self.drivers)
+        self.polyConfig = poly.config
+        self.nodes = {}
+
+    def addNode(self, node, update=False):
+        self.nodes[node.address] = node
+        self.poly.addNode(node)
+        return node
+
+    def updateNode(self, node):
+        self.nodes[node.address] = node
+        self.poly.addNode(node)
+
+    def delNode(self, address):
+        self.nodes.pop(address, None)
+        self.poly.delNode(address)
+
+    def stop(self):
+        pass
+
+
+def install_polyinterface(level=logging.WARNING):
+    """
+    Registers a fake polyinterface module, must be called before the node server is loaded
+    """
+    module = types.ModuleType('polyinterface')
+    module.LOGGER = logging.getLogger('dyson-poly')
+    module.LOGGER.setLevel(level)
+    if not module.LOGGER.handlers:
+        module.LOGGER.addHandler(logging.StreamHandler(sys.stderr))
+    module.Interface = FakeInterface
+    module.Node = Node
+    module.Controller = Controller
+    sys.modules['polyinterface'] = module
+    return module
+
+
+def load_server(path=SERVER, level=logging.WARNING):
+    """
+    Imports dyson-poly.py under the name dyson_poly with the fake polyinterface in place
+    """
+    install_polyinterface(level)
+    spec = importlib.util.spec_from_file_location('dyson_poly', path)
+    server = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(server)
+    return server
+
+
+class MessageFactory(object):
+    """
+    Builds randomized state and environmental messages. Each field changes with the given
+    probability between consecutive messages, sensor values follow a bounded random walk.
+    """
+    def __init__(self, server, model, change=0.3, seed=None):
+        self.server = server
+        self.model = model
+        self.change = change
+        self.random = random.Random(seed)
+        node_class = server.PRODUCTS[MODELS[model]].load()
+        self.state_class, self.env_class = node_class.state_message, node_class.env_message
+        if model == 'v1':
+            self.state, self.env = dict(V1_STATE), dict(V1_ENV)
+        else:
+            self.state, self.env = dict(V2_STATE), dict(V2_ENV)
+
+    def _walk(self, data, field, low, high, step):
+        if field in data and self.random.random() < self.change:
+            value = min(high, max(low, int(data[field]) + self.random.randint(-step, step)))
+            data[field] = '{:04d}'.format(value)
+
+    def state_message(self):
+        self._walk(self.state, 'fnsp', 1, 10, 2)
+        self._walk(self.state, 'hmax', 2740, 3100, 10)
+        if self.random.random() < self.change / 4:
+            self.state['oson'] = self.random.choice(('ON', 'OFF') if self.model == 'v1' else ('OION', 'OIOF'))
+        if self.random.random() < self.change / 4:
+            self.state['nmod'] = self.random.choice(('ON', 'OFF'))
+        return self.state_class(json.dumps({'msg': 'CURRENT-STATE', 'product-state': self.state}))
+
+    def env_message(self):
+        self._walk(self.env, 'tact', 2700, 3100, 5)
+        self._walk(self.env, 'hact', 10, 90, 2)
+        for field in ('pm25', 'pm10', 'va10', 'noxl', 'pact', 'vact'):
+            self._walk(self.env, field, 0, 200, 3)
+        return self.env_class(json.dumps({'msg': 'ENVIRONMENTAL-CURRENT-SENSOR-DATA', 'data': self.env}))
+
+    def message(self, env_ratio=0.8):
+        return self.env_message() if self.random.random() < env_ratio else self.state_message()
+
+
+class FakeDevice(object):
+    """
+    Enough of a libpurecool device for a node: listeners, current state and recorded commands
+    """
+    def __init__(self, serial, name, product_type, factory):
+        self.serial = serial
+        self.name = name
+        self.product_type = product_type
+        self.credentials = 'fake'
+        self.version = '1.0'
+        self.active = True
+        self.auto_update = True
+        self.new_version_available = False
+        self.network_device = None
+        self.listeners = []
+        self.commands = []
+        self.state = factory.state_message()
+        self.environmental_state = factory.env_message()
+
+    def connect(self, ip, port=1883):
+        return True
+
+    def auto_connect(self, timeout=5, retry=15):
+        return True
+
+    def disconnect(self):
+        pass
+
+    def add_message_listener(self, callback):
+        self.listeners.append(callback)
+
+    def remove_message_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def emit(self, msg):
+        if type(msg) is type(self.state):
+            self.state = msg
+        elif type(msg) is type(self.environmental_state):
+            self.environmental_state = msg
+        for callback in list(self.listeners):
+            callback(msg)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+        return command
+
+
+class FakeAccount(object):
+    """
+    DysonAccount replacement that hands out a fixed device list
+    """
+    devices_list = []
+
+    def __init__(self, *args, **kwargs):
+        self.logged = False
+
+    def login(self):
+        self.logged = True
+        return True
+
+    def devices(self):
+        return list(self.devices_list)
+
+
+def make_fleet(server, counts, change=0.3, seed=None):
+    """
+    Creates fake devices with message factories, counts is a {model: number} dict
+    """
+    rnd = random.Random(seed)
+    fleet = []
+    for model, count in counts.items():
+        for i in range(count):
+            factory = MessageFactory(server, model, change, rnd.random())
+            serial = '{}-US-{}{:04d}'.format(model.upper()[:3], 'SIM', i)
+            device = FakeDevice(serial, '{} {}'.format(model, i), MODELS[model], factory)
+            fleet.append((device, factory))
+    return fleet
+
+
+def start_controller(server, fleet, params=None, workdir=None):
+    """
+    Starts the controller against the fake account and marks every node connected. The
+    controller keeps its caches in the working directory, a temporary one by default.
+    """
+    os.chdir(workdir or tempfile.mkdtemp(prefix='dyson-bench-'))
+    FakeAccount.devices_list = [device for device, _ in fleet]
+    poly = FakeInterface(dict({'username': 'bench', 'password': 'bench'}, **(params or {})))
+    controller = server.Controller(poly)
+    controller._new_account = FakeAccount
+    controller.start()
+    nodes = controller.fan_nodes()
+    for node in nodes.values():
+        node.on_connected()
+    return controller, poly
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Replays a device traffic capture (capture parameter, logs/capture.jsonl) through the node
+classes without Polyglot or real devices, at the recorded speed or as fast as possible, and
+reports throughput, per message latency, setDriver calls and published driver updates.
+
+    python3 tools/replay.py logs/capture.jsonl.1 logs/capture.jsonl
+    python3 tools/replay.py logs/capture.jsonl --speed 0 --profile 20
+"""
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import argparse
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakes
+from bench import percentiles, SetDriverCounter, wait_dispatched
+
+
+def read_capture(paths, serials=None):
+    """
+    Reads capture lines from all files, rotated ones included, in time order
+    """
+    records = []
+    skipped = 0
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    if serials and entry['serial'] not in serials:
+                        continue
+                    records.append((entry['time'], entry['serial'], entry['type'], json.dumps(entry['payload'])))
+                except (ValueError, KeyError, TypeError):
+                    skipped += 1
+    records.sort(key=lambda record: record[0])
+    return records, skipped
+
+
+def build_fleet(server, records):
+    """
+    Creates one fake device per captured serial number, with the message factory of its model
+    """
+    models = {server.PRODUCTS[product_type]: model for model, product_type in fakes.MODELS.items()}
+    fleet = []
+    seen = set()
+    for _, serial, product_type, _ in records:
+        if serial in seen:
+            continue
+        seen.add(serial)
+        node_class = server.PRODUCTS.get(product_type)
+        if node_class is None:
+            print('Skipping {}, product type {} is not supported'.format(serial, product_type), file=sys.stderr)
+            continue
+        factory = fakes.MessageFactory(server, models[node_class])
+        fleet.append((fakes.FakeDevice(serial, serial, product_type, factory), factory))
+    return fleet
+
+
+def build_schedule(server, records, devices):
+    """
+    Turns payloads into libpurecool messages the same way the library does, before anything is timed
+    """
+    from libpurecool.dyson_pure_state import DysonPureCoolState, DysonEnvironmentalSensorState
+    index = {device.serial: idx for idx, device in enumerate(devices)}
+    schedule = []
+    unknown = 0
+    started = records[0][0] if records else 0
+    for recorded, serial, product_type, payload in records:
+        if serial not in index:
+            continue
+        node_class = server.PRODUCTS[product_type].load()
+        if DysonPureCoolState.is_state_message(payload):
+            msg = node_class.state_message(payload)
+        elif DysonEnvironmentalSensorState.is_environmental_state_message(payload):
+            msg = node_class.env_message(payload)
+        else:
+            unknown += 1
+            continue
+        schedule.append((recorded - started, index[serial], msg))
+    return schedule, unknown
+
+
+def replay(nodes, devices, schedule, speed, dispatch):
+    latencies = []
+    started = time.perf_counter()
+    for offset, idx, msg in schedule:
+        if speed > 0:
+            delay = started + offset / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if dispatch:
+            devices[idx].emit(msg)
+        else:
+            t0 = time.perf_counter()
+            nodes[idx].process_message(msg)
+            latencies.append(time.perf_counter() - t0)
+    return latencies, time.perf_counter() - started
+
+
+def run(args):
+    server = fakes.load_server(args.server)
+    records, skipped = read_capture(args.capture, set(args.device) if args.device else None)
+    fleet = build_fleet(server, records)
+    if not fleet:
+        sys.exit('No messages to replay')
+    params = dict(json.loads(args.params)) if args.params else {}
+    if args.dispatch:
+        params.setdefault('dispatch_queue', str(max(1024, len(fleet) * 4)))
+    controller, poly = fakes.start_controller(server, fleet, params)
+    devices = [device for device, _ in fleet]
+    by_serial = {node.device.serial: node for node in controller.fan_nodes().values()}
+    nodes = [by_serial[device.serial] for device in devices]
+    schedule, unknown = build_schedule(server, records, devices)
+    report = {'devices': len(nodes), 'messages': len(schedule), 'skipped_lines': skipped, 'unknown_messages': unknown,
+              'captured_s': schedule[-1][0] if schedule else 0, 'speed': args.speed, 'mode': 'dispatch' if args.dispatch else 'direct'}
+
+    profiler = cProfile.Profile() if args.profile else None
+    status_before = poly.status
+    started = time.perf_counter()
+    with SetDriverCounter(server) as counter:
+        if profiler is not None:
+            profiler.enable()
+        latencies, elapsed = replay(nodes, devices, schedule, args.speed, args.dispatch)
+        if args.dispatch:
+            wait_dispatched(controller, len(schedule))
+            elapsed = time.perf_counter() - started
+        if profiler is not None:
+            profiler.disable()
+    published = poly.status - status_before
+    report['elapsed_s'] = elapsed
+    report['throughput_msg_s'] = len(schedule) / elapsed if elapsed else 0
+    report['latency_us'] = {k: v * 1e6 for k, v in percentiles(latencies).items()}
+    if args.dispatch:
+        report['dispatch'] = controller.dispatcher.stats()
+        # collapsed and dropped messages were never applied, only processed ones count as throughput
+        report['offered_msg_s'] = report['throughput_msg_s']
+        report['throughput_msg_s'] = report['dispatch']['processed'] / elapsed if elapsed else 0
+        report['processing_ms'] = server.LatencyHistogram.merged(node.metrics.processing for node in nodes).to_dict()
+    report['set_driver_calls'] = counter.calls
+    report['published'] = published
+    report['per_device'] = dict(Counter(devices[idx].serial for _, idx, _ in schedule))
+    report['drivers'] = {node.device.serial: node.driver_values() for node in nodes} if args.drivers else None
+    controller.stop()
+    if profiler is not None:
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats('cumulative').print_stats(args.profile)
+    return report
+
+
+def print_report(report):
+    print('devices: {devices}, messages: {messages} over {captured_s:.1f}s captured, {skipped_lines} bad lines, {unknown_messages} unknown messages'.format(**report))
+    speed = 'full speed' if report['speed'] <= 0 else '{:g}x'.format(report['speed'])
+    if 'offered_msg_s' in report:
+        print('replayed at {} in {:.3f}s, offered load {:.0f} msg/s, mode: {}'.format(speed, report['elapsed_s'], report['offered_msg_s'], report['mode']))
+    else:
+        print('replayed at {} in {:.3f}s, {:.0f} msg/s, mode: {}'.format(speed, report['elapsed_s'], report['throughput_msg_s'], report['mode']))
+    if report['latency_us']:
+        print('latency us: ' + ', '.join('{} {:.1f}'.format(k, v) for k, v in report['latency_us'].items()))
+    if 'processing_ms' in report:
+        print('processing ms: mean {mean}, p50 {p50}, p95 {p95}, p99 {p99}, max {max}'.format(**report['processing_ms']))
+        print('dispatch: processed {processed} ({rate:.0f} msg/s), collapsed {collapsed}, dropped {dropped}'.format(rate=report['throughput_msg_s'], **report['dispatch']))
+    print('setDriver calls: {set_driver_calls}, published updates: {published}'.format(**report))
+    for serial, count in sorted(report['per_device'].items()):
+        print('    {}: {} messages'.format(serial, count))
+    if report['drivers']:
+        for serial, values in sorted(report['drivers'].items()):
+            print('    {}: {}'.format(serial, ' '.join('{}={}'.format(k, v) for k, v in values.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('capture', nargs='+', help='capture files, rotated ones in any order')
+    parser.add_argument('--speed', type=float, default=1, help='multiple of the recorded speed, 0 replays as fast as possible')
+    parser.add_argument('--device', action='append', help='replay only this serial number, can be repeated')
+    parser.add_argument('--dispatch', action='store_true', help='deliver through the device listeners and message dispatcher')
+    parser.add_argument('--params', help='customParams JSON, for example {"trace": "changes"}')
+    parser.add_argument('--profile', type=int, default=0, metavar='N', help='profile the replay and print the top N functions')
+    parser.add_argument('--drivers', action='store_true', help='print the final driver values of every node')
+    parser.add_argument('--server', default=fakes.SERVER, help='node server file to load')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Simulated Dyson fleet for end to end load tests. Every device gets its own minimal MQTT
+3.1.1 broker on a loopback address (127.x.y.z:1883 on Linux), answers state and sensor
+requests, applies STATE-SET commands and pushes sensor data at the configured rate.
+
+The simulator writes device_cache.json and devlist.json to the output directory, so a
+node server started from that directory brings the devices up from the cache and
+connects to them through the devlist path. Set the offline parameter to true: with real
+Dyson cloud credentials the background cloud refresh would remove the simulated nodes
+and overwrite device_cache.json with the devices of the account.
+
+    python3 tools/simulator.py --v2 100 --hotcool 50 --v1 50 --out /path/to/nodeserver
+"""
+import os
+import sys
+import json
+import time
+import random
+import struct
+import asyncio
+import argparse
+import ipaddress
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import V2_STATE, V2_ENV, V1_STATE, V1_ENV, MODELS
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+CONNACK_ACCEPTED = 0
+CONNACK_BAD_CREDENTIALS = 4
+
+SERIAL_PREFIX = {'v2': 'SV2', 'hotcool': 'SHC', 'v1': 'SV1'}
+
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _packet(packet_type, flags, body):
+    return bytes([packet_type << 4 | flags]) + _encode_length(len(body)) + body
+
+
+def _string(value):
+    data = value.encode('utf-8') if isinstance(value, str) else value
+    return struct.pack('!H', len(data)) + data
+
+
+def _read_string(body, pos):
+    length = struct.unpack_from('!H', body, pos)[0]
+    pos += 2
+    return body[pos:pos + length], pos + length
+
+
+def _topic_matches(topic_filter, topic):
+    filter_parts = topic_filter.split('/')
+    parts = topic.split('/')
+    for i, part in enumerate(filter_parts):
+        if part == '#':
+            return True
+        if i >= len(parts) or (part != '+' and part != parts[i]):
+            return False
+    return len(filter_parts) == len(parts)
+
+
+class SimDevice(object):
+    """
+    State of one simulated machine and the MQTT sessions connected to it
+    """
+    def __init__(self, model, index, ip, rnd, latency):
+        self.model = model
+        self.product_type = MODELS[model]
+        self.serial = '{}-US-{:06d}'.format(SERIAL_PREFIX[model], index)
+        self.name = 'Sim {} {}'.format(model, index)
+        self.credentials = '{:032x}'.format(rnd.getrandbits(128))
+        self.ip = ip
+        self.random = random.Random(rnd.random())
+        self.latency = latency
+        self.state = dict(V1_STATE if model == 'v1' else V2_STATE)
+        self.env = dict(V1_ENV if model == 'v1' else V2_ENV)
+        self.status_topic = '{}/{}/status/current'.format(self.product_type, self.serial)
+        self.command_topic = '{}/{}/command'.format(self.product_type, self.serial)
+        self.sessions = set()
+        self.connections = 0
+        self.commands = 0
+        self.published = 0
+
+    def cache_entry(self):
+        return {'serial': self.serial, 'product_type': self.product_type, 'name': self.name, 'version': 'SIM',
+                'credentials': self.credentials, 'active': True, 'auto_update': False, 'new_version_available': False}
+
+    def _now(self):
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+    def state_message(self, changes=None):
+        if changes is None:
+            return {'msg': 'CURRENT-STATE', 'time': self._now(), 'mode-reason': 'LAPP', 'state-reason': 'MODE', 'product-state': dict(self.state)}
+        return {'msg': 'STATE-CHANGE', 'time': self._now(), 'mode-reason': 'LAPP', 'state-reason': 'MODE',
+                'product-state': {field: [changes.get(field, value), value] for field, value in self.state.items()}}
+
+    def env_message(self):
+        for field, low, high, step in (('tact', 2700, 3100, 3), ('hact', 10, 90, 1), ('pm25', 0, 300, 2), ('pm10', 0, 300, 2),
+                                       ('va10', 0, 100, 1), ('noxl', 0, 100, 1), ('pact', 0, 9, 1), ('vact', 0, 9, 1)):
+            if field in self.env:
+                value = min(high, max(low, int(self.env[field]) + self.random.randint(-step, step)))
+                self.env[field] = '{:04d}'.format(value)
+        return {'msg': 'ENVIRONMENTAL-CURRENT-SENSOR-DATA', 'time': self._now(), 'data': dict(self.env)}
+
+    def apply(self, data):
+        """
+        Applies a STATE-SET payload and returns the previous values of the changed fields
+        """
+        changes = {}
+        for field, value in data.items():
+            if value == 'STET' or field not in self.state or self.state[field] == value:
+                continue
+            changes[field] = self.state[field]
+            self.state[field] = value
+        if self.model == 'v1':
+            fan_state = 'OFF' if self.state['fmod'] == 'OFF' else 'FAN'
+        else:
+            fan_state = 'OFF' if self.state['fpwr'] == 'OFF' else 'FAN'
+            if self.model == 'hotcool':
+                heating = 'HEAT' if self.state['hmod'] == 'HEAT' and int(self.env['tact']) < int(self.state['hmax']) else 'OFF'
+                if heating != self.state['hsta']:
+                    changes['hsta'] = self.state['hsta']
+                    self.state['hsta'] = heating
+        if fan_state != self.state['fnst']:
+            changes['fnst'] = self.state['fnst']
+            self.state['fnst'] = fan_state
+        return changes
+
+    def handle_command(self, payload):
+        self.commands += 1
+        try:
+            command = json.loads(payload)
+        except ValueError:
+            return None
+        msg = command.get('msg')
+        if msg == 'REQUEST-CURRENT-STATE':
+            return self.state_message()
+        if msg == 'REQUEST-PRODUCT-ENVIRONMENT-CURRENT-SENSOR-DATA':
+            return self.env_message()
+        if msg == 'STATE-SET':
+            changes = self.apply(command.get('data', {}))
+            return self.state_message(changes) if changes else None
+        return None
+
+    def publish(self, message):
+        payload = json.dumps(message).encode('utf-8')
+        for session in list(self.sessions):
+            if session.send(self.status_topic, payload):
+                self.published += 1
+
+
+class Session(object):
+    """
+    One MQTT client connection to a simulated device
+    """
+    def __init__(self, device, reader, writer):
+        self.device = device
+        self.reader = reader
+        self.writer = writer
+        self.subscriptions = set()
+
+    def send(self, topic, payload):
+        if self.writer.is_closing() or not any(_topic_matches(flt, topic) for flt in self.subscriptions):
+            return False
+        self.writer.write(_packet(PUBLISH, 0, _string(topic) + payload))
+        return True
+
+    async def read_packet(self):
+        header = await self.reader.readexactly(1)
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await self.reader.readexactly(1))[0]
+            length += (byte & 0x7f) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        body = await self.reader.readexactly(length) if length else b''
+        return header[0] >> 4, header[0] & 0x0f, body
+
+    def _check_connect(self, body):
+        _, pos = _read_string(body, 0)
+        level, flags = body[pos], body[pos + 1]
+        pos += 4
+        _, pos = _read_string(body, pos)
+        if flags & 0x04:
+            _, pos = _read_string(body, pos)
+            _, pos = _read_string(body, pos)
+        username = password = b''
+        if flags & 0x80:
+            username, pos = _read_string(body, pos)
+        if flags & 0x40:
+            password, pos = _read_string(body, pos)
+        return level == 4 and username.decode() == self.device.serial and password.decode() == self.device.credentials
+
+    async def run(self):
+        device = self.device
+        try:
+            packet_type, _, body = await self.read_packet()
+            if packet_type != CONNECT:
+                return
+            if not self._check_connect(body):
+                self.writer.write(_packet(CONNACK, 0, bytes([0, CONNACK_BAD_CREDENTIALS])))
+                await self.writer.drain()
+                return
+            self.writer.write(_packet(CONNACK, 0, bytes([0, CONNACK_ACCEPTED])))
+            device.connections += 1
+            device.sessions.add(self)
+            while True:
+                packet_type, flags, body = await self.read_packet()
+                if packet_type == PUBLISH:
+                    qos = flags >> 1 & 0x03
+                    topic, pos = _read_string(body, 0)
+                    if qos:
+                        packet_id = body[pos:pos + 2]
+                        pos += 2
+                        self.writer.write(_packet(PUBACK if qos == 1 else PUBREC, 0, packet_id))
+                    if topic.decode() == device.command_topic:
+                        reply = device.handle_command(body[pos:])
+                        if reply is not None:
+                            if device.latency:
+                                await asyncio.sleep(device.latency)
+                            device.publish(reply)
+                elif packet_type == PUBREL:
+                    self.writer.write(_packet(PUBCOMP, 0, body[:2]))
+                elif packet_type == SUBSCRIBE:
+                    pos = 2
+                    granted = bytearray()
+                    while pos < len(body):
+                        topic, pos = _read_string(body, pos)
+                        self.subscriptions.add(topic.decode())
+                        granted.append(min(body[pos], 1))
+                        pos += 1
+                    self.writer.write(_packet(SUBACK, 0, body[:2] + bytes(granted)))
+                elif packet_type == UNSUBSCRIBE:
+                    pos = 2
+                    while pos < len(body):
+                        topic, pos = _read_string(body, pos)
+                        self.subscriptions.discard(topic.decode())
+                    self.writer.write(_packet(UNSUBACK, 0, body[:2]))
+                elif packet_type == PINGREQ:
+                    self.writer.write(_packet(PINGRESP, 0, b''))
+                elif packet_type == DISCONNECT:
+                    return
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, IndexError, struct.error, UnicodeDecodeError):
+            pass
+        finally:
+            device.sessions.discard(self)
+            self.writer.close()
+
+
+class Fleet(object):
+    def __init__(self, args):
+        rnd = random.Random(args.seed)
+        self.args = args
+        self.devices = []
+        address = ipaddress.IPv4Address(args.base_ip)
+        index = 0
+        for model in ('v2', 'hotcool', 'v1'):
+            for i in range(getattr(args, model)):
+                while str(address).endswith(('.0', '.255')):
+                    address += 1
+                self.devices.append(SimDevice(model, index, str(address), rnd, args.latency / 1000))
+                address += 1
+                index += 1
+
+    def write_files(self, out):
+        os.makedirs(out, exist_ok=True)
+        with open(os.path.join(out, 'device_cache.json'), 'w') as f:
+            json.dump({'devices': [device.cache_entry() for device in self.devices]}, f, indent=1)
+        devlist = [{'sn': device.serial, 'ip': device.ip} for device in self.devices]
+        with open(os.path.join(out, 'devlist.json'), 'w') as f:
+            json.dump(devlist, f, separators=(',', ':'))
+        return devlist
+
+    async def _push(self, device, interval, make):
+        await asyncio.sleep(device.random.uniform(0, interval))
+        while True:
+            device.publish(make())
+            await asyncio.sleep(interval * device.random.uniform(0.9, 1.1))
+
+    def _random_change(self, device):
+        field = device.random.choice(('fnsp', 'nmod'))
+        if field == 'fnsp' and device.state['fnsp'] != 'AUTO':
+            value = '{:04d}'.format(device.random.randint(1, 10))
+        else:
+            value = 'ON' if device.state['nmod'] == 'OFF' else 'OFF'
+        changes = device.apply({field: value})
+        return device.state_message(changes)
+
+    async def _report(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            print('{} sessions on {}/{} devices, {} connects, {} commands, {} published'.format(
+                sum(len(device.sessions) for device in self.devices), sum(1 for device in self.devices if device.sessions),
+                len(self.devices), sum(device.connections for device in self.devices), sum(device.commands for device in self.devices),
+                sum(device.published for device in self.devices)), flush=True)
+
+    async def run(self):
+        args = self.args
+        servers = []
+        for device in self.devices:
+            handler = (lambda dev: lambda reader, writer: Session(dev, reader, writer).run())(device)
+            servers.append(await asyncio.start_server(handler, device.ip, args.port))
+        tasks = []
+        for device in self.devices:
+            if args.env_interval > 0:
+                tasks.append(asyncio.ensure_future(self._push(device, args.env_interval, device.env_message)))
+            if args.state_interval > 0:
+                tasks.append(asyncio.ensure_future(self._push(device, args.state_interval, lambda dev=device: self._random_change(dev))))
+        if args.stats_interval > 0:
+            tasks.append(asyncio.ensure_future(self._report(args.stats_interval)))
+        print('Simulating {} device(s) on {}..{} port {}'.format(len(self.devices), self.devices[0].ip, self.devices[-1].ip, args.port), flush=True)
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--v2', type=int, default=10, help='Pure Cool devices')
+    parser.add_argument('--hotcool', type=int, default=5, help='Pure Hot+Cool devices')
+    parser.add_argument('--v1', type=int, default=5, help='Pure Cool Link devices')
+    parser.add_argument('--base-ip', default='127.10.0.1', help='first loopback address, Linux routes all of 127.0.0.0/8 to lo')
+    parser.add_argument('--port', type=int, default=1883, help='MQTT port, libpurecool always connects to 1883')
+    parser.add_argument('--env-interval', type=float, default=30, help='seconds between unsolicited sensor messages, 0 answers requests only')
+    parser.add_argument('--state-interval', type=float, default=0, help='seconds between random state changes, 0 disables them')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds before a device answers a command')
+    parser.add_argument('--stats-interval', type=float, default=10, help='seconds between activity reports, 0 disables them')
+    parser.add_argument('--out', default='.', help='directory for device_cache.json and devlist.json')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    fleet = Fleet(args)
+    if not fleet.devices:
+        sys.exit('No devices to simulate')
+    devlist = fleet.write_files(args.out)
+    print('Wrote device_cache.json and devlist.json to {}, set offline to true and the devlist parameter to the contents of devlist.json ({} devices)'.format(
+        os.path.abspath(args.out), len(devlist)), flush=True)
+    try:
+        asyncio.run(fleet.run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()